@@ -0,0 +1,823 @@
+"""
+asyncio Sedna Protocol Driver
+
+The same wire protocol as zif.sedna.protocol, over asyncio streams, for
+applications that run in an asyncio event loop.  Nothing here blocks the
+loop.  This module requires python 3.7 or later.
+
+Usage:
+
+    conn = await aio.connect(host,db,login,passwd,port)
+
+    await conn.begin()    - optional. sent before the first query if necessary.
+    result = await conn.execute(u'some_query')
+
+    - result is an async iterator that returns python unicode strings.
+
+        async for item in result:
+            ...
+
+    - await result.value() gives the entire result as a single string.
+
+    await conn.commit()
+    await conn.close()
+
+    await conn.loadText(source,doc_name) - load some text as doc_name
+    await conn.loadFile(filename,doc_name) - load a file as doc_name
+
+Connections may be pooled:
+
+    pool = aio.AsyncConnectionPool(host,db,login,passwd,port,pool_size=5)
+    async with pool.connection() as conn:
+        result = await conn.execute(u'some_query')
+        ...
+    await pool.dispose()
+
+A connection returned to the pool in a transaction is rolled back.
+
+"""
+
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+# Sedna token constants
+from zif.sedna.msgcodes import *
+
+# standard errors from PEP-249
+from zif.sedna.dbapiexceptions import Error, Warning, InterfaceError,\
+DatabaseError, InternalError, OperationalError, ProgrammingError,\
+IntegrityError, DataError, NotSupportedError
+
+# message encoding and decoding, shared with zif.sedna.protocol
+from zif.sedna.codec import SEDNA_MAX_BODY_LENGTH, HEADER, DATA_OFFSET,\
+message, zStringMessage, executeMessage, portions, sessionOptionMessage,\
+sessionParametersMessage, ErrorInfo, DebugInfo
+
+from zif.sedna.protocol import LOAD_BUFFER_SIZE, BULKLOAD_READ_SIZE,\
+splitString
+
+
+async def connect(host='localhost',db="test",login="SYSTEM",passwd="MANAGER",
+        port=5050):
+    """return an open, authenticated AsyncSednaProtocol"""
+    conn = AsyncSednaProtocol(host,db,login,passwd,port)
+    await conn.open()
+    return conn
+
+
+class AsyncResult(object):
+    """Object representing the result of a query. async iterable.
+
+    Iterating over a result will yield a python unicode string for each
+    "item", or a utf-8 encoded bytestring if the query was bytes.
+
+    await result.value() returns the entire result as a single string.
+
+    await result.time() returns a string with the server processing time.
+
+    """
+
+    def __init__(self,conn,returnUnicode):
+        self.conn = conn
+        self._time = None
+        self.more = True
+        self.item = None
+        self.returnUnicode = returnUnicode
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        currItem = self.item
+        if currItem is None:
+            raise StopAsyncIteration
+        if self.more:
+            await self.conn._send_string(token=SEDNA_GET_NEXT_ITEM)
+        else:
+            self.item = None
+        if self.returnUnicode:
+            return currItem.decode('utf-8')
+        return currItem
+
+    async def value(self):
+        items = [item async for item in self]
+        if self.returnUnicode:
+            return u''.join(items)
+        return b''.join(items)
+
+    async def time(self):
+        if not self._time:
+            self._time = await self.conn._send_string(token=SEDNA_SHOW_TIME)
+        return self._time
+
+    # called by the protocol handlers
+
+    def _receiveItem(self,item):
+        self.item = item
+
+    def _receiveEnd(self,item):
+        self.more = False
+        self.item = item
+
+
+class AsyncSednaProtocol(object):
+    """Sedna protocol over asyncio streams
+
+    init with
+    host         string host name or ip address
+    db           string sedna database name to connect to
+    login        string user name
+    passwd       string user password
+    port         int    port for connection default:5050
+
+    then await open(), or use the connect() coroutine, which does both.
+
+    Exceptions are raised when operations fail.
+
+    Query execution must take place within a transaction.  As in
+    zif.sedna.protocol, there is only one query and one result at a time on
+    a connection; a transaction holds the connection's lock, so other tasks
+    wanting a transaction on the same connection wait for it to finish.
+
+    successful updates return True
+
+    """
+    prefixLength = HEADER.size
+    maxDataLength = SEDNA_MAX_BODY_LENGTH - prefixLength
+    maxQueryLength = SEDNA_MAX_BODY_LENGTH
+    result = None
+    closed = True
+    returnUnicode = True
+    _inTransaction = False
+    _inputBuffer = None
+    _progress = None
+    _lock = None
+    ermsgs = None
+
+    # error exposition (PEP-249)
+    Error = Error
+    Warning = Warning
+    InterfaceError = InterfaceError
+    DatabaseError = DatabaseError
+    InternalError = InternalError
+    OperationalError = OperationalError
+    ProgrammingError = ProgrammingError
+    IntegrityError = IntegrityError
+    DataError = DataError
+    NotSupportedError = NotSupportedError
+
+    def __init__(self,host='localhost',db="test",login="SYSTEM",
+        passwd="MANAGER",port=5050):
+        self.host = host
+        self.port = port
+        self.username = login
+        self.password = passwd
+        self.database = db
+        self.ermsgs = []
+        self.currItem = []
+        self.reader = self.writer = None
+
+    async def open(self):
+        """connect and authenticate"""
+        try:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host,self.port)
+        except OSError as e:
+            raise InterfaceError(
+                'Server connection failed. Is Sedna server running? %s' % e)
+        self.closed = False
+        await self._send_string(token=SEDNA_START_UP)
+
+# Public interfaces
+
+    # queries
+
+    async def execute(self, query, format=0, pretty_print=False, nsmap=None):
+        """
+        Send query to the Sedna server.
+
+        query should be unicode or otherwise encodable to utf-8
+        format is 0 for XML
+                  1 for SXML
+
+        nsmap is a dict with namespace mapping.
+        """
+        self.ermsgs = []
+        self.currItem = []
+        self.result = None
+        if isinstance(query,str):
+            query = query.encode('utf-8')
+            self.returnUnicode = True
+        else:
+            self.returnUnicode = False
+        out = []
+        if nsmap:
+            for item in nsmap:
+                out.append(('declare namespace %s="%s";' % (item,
+                    nsmap[item])).encode('utf-8'))
+        if not pretty_print:
+            out.append(b'declare option se:output "indent=no";')
+        out.append(query)
+        query = b'\n'.join(out)
+        if not self.inTransaction:
+            await self.begin()
+        await self._send_string(query,token=SEDNA_EXECUTE,format=format)
+        return self.result
+
+    query = execute
+
+    async def close(self):
+        """close the connection"""
+        if self.writer is not None and not self.closed:
+            await self._send_string(token=SEDNA_CLOSE_CONNECTION)
+            self.closed = True
+
+    # transactions
+
+    async def begin(self):
+        """
+        start transaction
+        """
+        # as in the synchronous protocol, hold the instance lock for the
+        # length of the transaction.
+        if not self.inTransaction:
+            await self.lock.acquire()
+            try:
+                await self._send_string(token=SEDNA_BEGIN_TRANSACTION)
+            except BaseException:
+                if not self.inTransaction and self.lock.locked():
+                    self.lock.release()
+                raise
+
+    beginTransaction = begin
+
+    async def commit(self):
+        """
+        commit transaction
+        """
+        return await self._send_string(token=SEDNA_COMMIT_TRANSACTION)
+
+    async def rollback(self):
+        """
+        rollback transaction
+        """
+        return await self._send_string(token=SEDNA_ROLLBACK_TRANSACTION)
+
+    async def endTransaction(self,how):
+        if how == 'commit':
+            await self.commit()
+        elif how == 'rollback':
+            await self.rollback()
+        else:
+            raise ProgrammingError(
+                "Expected 'commit' or 'rollback', got '%s'" % how)
+
+    def transactionStatus(self):
+        if self.inTransaction:
+            return 'active'
+        else:
+            return 'none'
+
+    # bulk loading
+
+    async def loadText(self,text,document_name,collection_name=None,
+            progress=None):
+        """
+        load text into the database as document_name
+
+        text may be a string, bytes (sent as-is, so mind the encoding in the
+        XML declaration), a file-like object opened for reading, or an
+        async iterable of strings or bytes.
+
+        if collection_name is provided, document will go in that
+        collection.
+
+        progress, if provided, is called as progress(sent, rate) while the
+        document is sent, with the number of bytes sent so far and the rate
+        in bytes per second.
+        """
+        self._inputBuffer = text
+        s = u'LOAD STDIN "%s"' % document_name
+        if collection_name:
+            s += u' "%s"' % collection_name
+        self._progress = progress
+        try:
+            res = await self.execute(s,pretty_print=True)
+        finally:
+            #always clear input buffer
+            self._inputBuffer = None
+            self._progress = None
+        return res
+
+    async def loadFile(self,filename,document_name,collection_name=None,
+            progress=None):
+        """
+        have the server ask for a local file by name and load it as
+        document_name
+
+        progress is as for loadText.
+        """
+        s = u'LOAD "%s" "%s"' % (filename, document_name)
+        if collection_name:
+            s += u' "%s"' % collection_name
+        self._progress = progress
+        try:
+            return await self.execute(s,pretty_print=True)
+        finally:
+            self._progress = None
+
+    async def loadModule(self,filename):
+        s = u'LOAD OR REPLACE MODULE "%s"' % (filename)
+        return await self.execute(s,pretty_print=True)
+
+    # session options
+
+    async def setReadonly(self, bool):
+        """
+        await connection.setReadonly(True)
+        await connection.setReadonly(False)
+        """
+        if bool:
+            val = READONLY_TRANSACTION
+        else:
+            val = UPDATE_TRANSACTION
+        await self._setSessionOption(val)
+
+    async def debugOn(self):
+        """
+        Sedna should send debugging info.
+        """
+        await self._setSessionOption(DEBUG_ON)
+
+    async def debugOff(self):
+        """
+        Sedna stops sending debugging info
+        """
+        await self._setSessionOption(DEBUG_OFF)
+
+    async def resetSessionOptions(self):
+        """
+        Put session options back to default.
+        """
+        await self._send_string(token=SEDNA_RESET_SESSION_OPTIONS)
+
+    def setDebugHandler(self,fn):
+        self.handleDebug = fn
+
+    def handleDebug(self,debugInfo):
+        """Handle debug information.
+
+        override this or use setDebugHandler.  Called with a DebugInfo
+        object when debug info is available as part of a query result.
+        """
+        raise NotImplementedError
+
+# the rest of the module is non-public methods
+
+    def get_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+    lock = property(get_lock)
+
+    def _getInTransaction(self):
+        return self._inTransaction
+
+    def _setInTransaction(self,bool):
+        self._inTransaction = bool
+        if not bool and self.lock.locked():
+            # release lock.  Transaction is complete.
+            self.lock.release()
+
+    inTransaction = property(_getInTransaction,_setInTransaction)
+
+    async def _setSessionOption(self,option):
+        await self._sendMessage(sessionOptionMessage(option))
+
+# communication with the server
+
+    async def _send_string(self,data=b'',token=0,format=0,respond=True):
+        """
+        send a message to the server, then get the response unless respond
+        is False.
+
+        too-long queries are split into EXECUTE_LONG messages followed by
+        LONG_QUERY_END.
+        """
+        write = self.writer.write
+        if token in (SEDNA_EXECUTE, SEDNA_EXECUTE_LONG):
+            self.result = None
+            if len(data)+self.prefixLength > self.maxQueryLength:
+                for split in splitString(data,LOAD_BUFFER_SIZE):
+                    write(executeMessage(split,format,SEDNA_EXECUTE_LONG))
+                data = message(SEDNA_LONG_QUERY_END)
+            else:
+                data = executeMessage(data,format,token)
+        elif len(data)+self.prefixLength > self.maxDataLength:
+            raise InterfaceError("Message is too long.")
+        else:
+            data = message(token,data)
+        return await self._sendMessage(data,respond)
+
+    async def _sendMessage(self,data,respond=True):
+        """
+        send a complete, already-encoded message, then get the response
+        unless respond is False.
+        """
+        self.writer.write(data)
+        try:
+            await self.writer.drain()
+        except OSError as e:
+            raise InterfaceError('Error writing to socket: %s' % e)
+        if respond:
+            return await self._get_response()
+
+    async def _get_response(self):
+        """get the response
+
+        read messages until a handler completes the response, and return
+        what that handler returns.
+        """
+        readexactly = self.reader.readexactly
+        handlers = self.handlers
+        partial = self.partialResponses
+        prefixLen = self.prefixLength
+        while True:
+            try:
+                token, length = HEADER.unpack(await readexactly(prefixLen))
+                msg = await readexactly(length)
+            except (asyncio.IncompleteReadError, OSError) as e:
+                raise InterfaceError('Error reading from socket: %s' % e)
+            if token == SEDNA_ITEM_PART:
+                # 5 is Int + byte
+                self.currItem.append(msg[DATA_OFFSET:])
+                continue
+            value = await handlers[token](self, msg)
+            if token not in partial:
+                return value
+
+# handlers
+
+# start-up
+
+    async def _sendSessionParameters(self,msg):
+        await self._sendMessage(sessionParametersMessage(self.username,
+            self.database),respond=False)
+
+# authentication
+
+    async def _sendAuthParameters(self,msg):
+        await self._sendMessage(zStringMessage(SEDNA_AUTHENTICATION_PARAMETERS,
+            self.password),respond=False)
+
+    async def _authenticationOK(self,msg):
+        pass
+
+    async def _authenticationFailed(self,msg):
+        error = ErrorInfo(msg)
+        self._closeSocket()
+        raise OperationalError(error.info)
+
+# protocol error noticed by the server
+
+    async def _errorResponse(self,msg):
+        error = ErrorInfo(msg)
+        if self.inTransaction:
+            self.inTransaction = False
+        self.ermsgs.append(error.info)
+        raise DatabaseError('\n'.join(self.ermsgs))
+
+# transactions - receivers
+
+    async def _beginTransactionOK(self,msg):
+        self._inTransaction = True
+
+    async def _beginTransactionFailed(self,msg):
+        error = ErrorInfo(msg)
+        if self.inTransaction:
+            self.inTransaction = False
+        raise DatabaseError(error.info)
+
+    async def _commitTransactionOK(self,msg):
+        self.inTransaction = False
+        return True
+
+    async def _commitTransactionFailed(self,msg):
+        error = ErrorInfo(msg)
+        self.inTransaction = False
+        raise DatabaseError(error.info)
+
+    async def _rollbackTransactionOK(self,msg):
+        if self.inTransaction:
+            self.inTransaction = False
+        return True
+
+    async def _rollbackTransactionFailed(self,msg):
+        if self.inTransaction:
+            self.inTransaction = False
+        error = ErrorInfo(msg)
+        raise DatabaseError(error.info)
+
+# queries - receivers
+
+    async def _querySucceeded(self,msg):
+        # the first item follows; _get_response keeps reading until we
+        # have it.
+        self.result = AsyncResult(self,self.returnUnicode)
+        return self.result
+
+    async def _queryFailed(self,msg):
+        error = ErrorInfo(msg)
+        raise ProgrammingError(error.info)
+
+    async def _updateSucceeded(self,msg):
+        self.result = True
+        return self.result
+
+    async def _updateFailed(self,msg):
+        error = ErrorInfo(msg)
+        raise DatabaseError(error.info)
+
+# bulk load - receivers
+
+    async def _bulkloadPortions(self,chunks):
+        """
+        send each chunk as maximum-size SEDNA_BULKLOAD_PORTIONs, then
+        BULKLOAD_END
+        """
+        progress = self._progress
+        sent = 0
+        started = time.monotonic()
+        write = self.writer.writelines
+        async for data in chunks:
+            if isinstance(data,str):
+                data = data.encode('utf-8')
+            if not data:
+                continue
+            write(portions(data))
+            try:
+                await self.writer.drain()
+            except OSError as e:
+                raise InterfaceError('Error writing to socket: %s' % e)
+            sent += len(data)
+            if progress is not None:
+                elapsed = time.monotonic() - started
+                progress(sent, sent / elapsed if elapsed else 0.0)
+        await self._send_string(token=SEDNA_BULKLOAD_END,respond=False)
+
+    async def _bulkloadFilename(self,msg):
+        """
+        upload the file the server asked for
+        """
+        # Int and a byte = 5
+        theFile = open(msg[DATA_OFFSET:],'rb')
+        try:
+            await self._bulkloadPortions(_readChunks(theFile))
+        finally:
+            theFile.close()
+
+    async def _bulkloadFromstream(self,msg):
+        await self._bulkloadPortions(_chunks(self._inputBuffer))
+
+    async def _bulkloadSucceeded(self,msg):
+        self._inputBuffer = None
+        self.result = True
+        return self.result
+
+    async def _bulkloadFailed(self,msg):
+        error = ErrorInfo(msg)
+        raise DatabaseError(error.info)
+
+    async def _lastQueryTime(self,msg):
+        #Int-and-a-byte = 5
+        return msg[DATA_OFFSET:].decode('utf-8')
+
+# Results processing
+
+    async def _itemEnd(self,msg):
+        item = b''.join(self.currItem)
+        self.currItem = []
+        self.result._receiveItem(item)
+
+    async def _resultEnd(self,msg):
+        if self.currItem:
+            item = b''.join(self.currItem)
+            self.currItem = []
+            self.result._receiveEnd(item)
+        else:
+            self.result._receiveEnd(None)
+
+# debug info
+
+    async def _debugInfo(self,msg):
+        di = DebugInfo(msg)
+        try:
+            self.handleDebug(di)
+        except NotImplementedError:
+            pass
+        self.ermsgs.append(di.info)
+
+# Connection and transaction feedback
+
+    def _closeSocket(self):
+        self.closed = True
+        self.writer.close()
+
+    async def _closeConnectionOK(self,msg):
+        self._closeSocket()
+
+    async def _transactionRollbackBeforeClose(self,msg):
+        self._closeSocket()
+        raise Warning("Transaction rolled back when connection closed")
+
+# setting session options
+
+    async def _setSessionOptionsOK(self,msg):
+        pass
+
+    async def _resetSessionOptionsOK(self,msg):
+        pass
+
+    handlers = {
+            SEDNA_SEND_SESSION_PARAMETERS : _sendSessionParameters,
+            SEDNA_SEND_AUTH_PARAMETERS : _sendAuthParameters,
+            SEDNA_AUTHENTICATION_OK : _authenticationOK,
+            SEDNA_AUTHENTICATION_FAILED : _authenticationFailed,
+
+            SEDNA_ERROR_RESPONSE : _errorResponse,
+
+            SEDNA_QUERY_SUCCEEDED : _querySucceeded,
+            SEDNA_QUERY_FAILED : _queryFailed,
+            SEDNA_UPDATE_SUCCEEDED : _updateSucceeded,
+            SEDNA_UPDATE_FAILED : _updateFailed,
+
+            SEDNA_BULKLOAD_FILENAME : _bulkloadFilename,
+            SEDNA_BULKLOAD_FROMSTREAM : _bulkloadFromstream,
+            SEDNA_BULKLOAD_SUCCEEDED : _bulkloadSucceeded,
+            SEDNA_BULKLOAD_FAILED : _bulkloadFailed,
+
+            SEDNA_BEGIN_TRANSACTION_OK : _beginTransactionOK,
+            SEDNA_BEGIN_TRANSACTION_FAILED : _beginTransactionFailed,
+            SEDNA_COMMIT_TRANSACTION_OK : _commitTransactionOK,
+            SEDNA_COMMIT_TRANSACTION_FAILED : _commitTransactionFailed,
+            SEDNA_ROLLBACK_TRANSACTION_OK : _rollbackTransactionOK,
+            SEDNA_ROLLBACK_TRANSACTION_FAILED : _rollbackTransactionFailed,
+
+            SEDNA_DEBUG_INFO : _debugInfo,
+            SEDNA_ITEM_END : _itemEnd,
+            SEDNA_RESULT_END : _resultEnd,
+
+            SEDNA_LAST_QUERY_TIME : _lastQueryTime,
+
+            SEDNA_CLOSE_CONNECTION_OK : _closeConnectionOK,
+            SEDNA_TRANSACTION_ROLLBACK_BEFORE_CLOSE : \
+                _transactionRollbackBeforeClose,
+            SEDNA_SET_SESSION_OPTIONS_OK : _setSessionOptionsOK,
+            SEDNA_RESET_SESSION_OPTIONS_OK : _resetSessionOptionsOK
+            }
+
+# responses that are followed by more of the same response.  Unlike the
+# synchronous protocol, the start-up and bulk load handlers send without
+# waiting, so the replies to what they send arrive here, too.
+
+    partialResponses = frozenset((
+            SEDNA_SEND_SESSION_PARAMETERS,
+            SEDNA_SEND_AUTH_PARAMETERS,
+            SEDNA_QUERY_SUCCEEDED,
+            SEDNA_DEBUG_INFO,
+            SEDNA_BULKLOAD_FILENAME,
+            SEDNA_BULKLOAD_FROMSTREAM,
+            ))
+
+
+async def _readChunks(filelike,size=BULKLOAD_READ_SIZE):
+    """read a file in a worker thread, so the event loop keeps running"""
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await loop.run_in_executor(None,filelike.read,size)
+        if not data:
+            break
+        yield data
+
+
+async def _chunks(source):
+    """async iterate over text, bytes, a file-like or an async iterable"""
+    if isinstance(source,(str,bytes)):
+        yield source
+    elif hasattr(source,'read'):
+        async for data in _readChunks(source):
+            yield data
+    else:
+        async for data in source:
+            yield data
+
+
+class AsyncConnectionPool(object):
+    """A pool of AsyncSednaProtocol connections
+
+    pool_size
+      The largest number of connections open at once.  Connections are
+      opened as needed and kept for reuse.  Defaults to 5.
+
+    timeout
+      The number of seconds to wait for a connection when pool_size
+      connections are in use before raising OperationalError.  Defaults
+      to 30.
+
+    Use acquire() and release(), or "async with pool.connection() as conn".
+    A connection is closed, not kept, when the body of connection() raises,
+    or when its rollback fails or is interrupted.
+    """
+
+    def __init__(self,host='localhost',db="test",login="SYSTEM",
+            passwd="MANAGER",port=5050,pool_size=5,timeout=30):
+        self._connect_args = (host,db,login,passwd,port)
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._idle = deque()
+        self._checkedout = 0
+        self._semaphore = None
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._pool_size)
+        return self._semaphore
+
+    async def acquire(self):
+        """return an open connection, waiting if pool_size are in use"""
+        semaphore = self._get_semaphore()
+        try:
+            await asyncio.wait_for(semaphore.acquire(),self._timeout)
+        except asyncio.TimeoutError:
+            raise OperationalError(
+                "AsyncConnectionPool limit of size %d reached, connection "
+                "timed out, timeout %d" % (self._pool_size,self._timeout))
+        try:
+            conn = None
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn.closed:
+                    break
+                conn = None
+            if conn is None:
+                conn = await connect(*self._connect_args)
+        except BaseException:
+            semaphore.release()
+            raise
+        self._checkedout += 1
+        return conn
+
+    async def release(self,conn,discard=False):
+        """
+        return a connection to the pool, rolling back an open transaction
+
+        The connection is closed instead if discard is true, or if the
+        rollback does not finish cleanly: a query that was interrupted, by
+        cancellation or a timeout, may have left its reply unread.
+        """
+        clean = False
+        try:
+            if not discard and not conn.closed:
+                if conn.inTransaction:
+                    await conn.rollback()
+                clean = True
+        except Error:
+            pass
+        finally:
+            if clean and not conn.closed:
+                self._idle.append(conn)
+            else:
+                self._discard(conn)
+            self._checkedout -= 1
+            self._get_semaphore().release()
+
+    def _discard(self,conn):
+        if not conn.closed:
+            conn._closeSocket()
+
+    @asynccontextmanager
+    async def connection(self):
+        conn = await self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            # the connection may be part way through a query
+            await self.release(conn,discard=True)
+            raise
+        await self.release(conn)
+
+    async def dispose(self):
+        """close the idle connections"""
+        while self._idle:
+            conn = self._idle.pop()
+            try:
+                await conn.close()
+            except Error:
+                self._discard(conn)
+
+    def status(self):
+        tup = (self._pool_size, len(self._idle), self._checkedout)
+        return "Pool size: %d  Connections in pool: %d "\
+            "Current Checked out connections: %d" % tup
@@ -0,0 +1,163 @@
+"""
+Client-side query result cache
+
+A ResultCache keeps the items of recent query results, so that running the
+same query again needs no server evaluation.  It is opt-in: set the
+resultCache attribute of a SednaProtocol connection.
+
+    from zif.sedna.cache import ResultCache
+    cache = ResultCache(ttl=5)
+    conn.resultCache = cache
+
+Connections may share a cache; give every connection of a pool the same
+one, e.g. in the pool's creator function.
+
+Queries are keyed on their full text, including the namespace and option
+declarations (so nsmap and pretty_print count).  With a cache, execute()
+strips the whitespace around queries, so that it does not matter.
+
+Only queries are cached.  Update statements (UPDATE, LOAD, DROP, CREATE, ...)
+are not, and when a transaction that executed one commits, the whole cache is
+cleared.  Until then, the updating connection bypasses the cache, so it sees
+its own changes.
+
+Results are cached only when they are read to the end.  Entries expire ttl
+seconds after they are stored, so changes made by other clients show up
+within ttl seconds.  The cache holds at most maxEntries results and maxBytes
+bytes of items.  Results bigger than maxResultBytes are not cached.  The
+least recently used entries are dropped first.
+
+stats() returns counts of hits, misses, stores, evictions, expirations and
+invalidations, with the current number of entries and bytes.
+"""
+
+import re
+import time
+
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
+
+from collections import OrderedDict
+
+# statements that change the database, after any prologue
+UPDATE_STATEMENT = re.compile(
+    r'^\s*(?:(?:declare|import)\s[^;]*;\s*)*'
+    r'(?:update|load|drop|create|grant|revoke|alter|backup)\b',
+    re.IGNORECASE)
+
+def isCacheable(query):
+    """True if query is a query, not an update statement"""
+    return UPDATE_STATEMENT.match(query) is None
+
+def normalizeQuery(query):
+    """query without the whitespace around it, which makes no difference"""
+    return query.strip()
+
+
+class ResultCache(object):
+    """LRU/TTL cache of query results
+
+    maxEntries      the most results kept
+    maxBytes        the most bytes of items kept, for all results together
+    maxResultBytes  results bigger than this are not cached; defaults to a
+                    quarter of maxBytes
+    ttl             seconds an entry stays valid
+    """
+
+    def __init__(self,maxEntries=1000,maxBytes=16*1048576,ttl=5.0,
+            maxResultBytes=None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        if maxResultBytes is None:
+            maxResultBytes = maxBytes // 4
+        self.maxResultBytes = maxResultBytes
+        self.ttl = ttl
+        # key: (expires, size, items), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = _threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self,key):
+        """return the cached list of items for key, or None"""
+        self._lock.acquire()
+        try:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            expires, size, items = entry
+            if expires < time.time():
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # most recently used goes last
+            self._entries[key] = entry
+            self.hits += 1
+            return items
+        finally:
+            self._lock.release()
+
+    def put(self,key,items,size):
+        """store items, a list of utf-8 strs of size bytes, for key"""
+        if size > self.maxResultBytes:
+            return
+        self._lock.acquire()
+        try:
+            entries = self._entries
+            old = entries.pop(key,None)
+            if old is not None:
+                self._bytes -= old[1]
+            while entries and (len(entries) >= self.maxEntries or
+                    self._bytes + size > self.maxBytes):
+                k, (expires, oldSize, oldItems) = entries.popitem(last=False)
+                self._bytes -= oldSize
+                self.evictions += 1
+            entries[key] = (time.time() + self.ttl, size, items)
+            self._bytes += size
+            self.stores += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """forget all results"""
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._bytes = 0
+            self.invalidations += 1
+        finally:
+            self._lock.release()
+
+    clear = invalidate
+
+    def stats(self):
+        """return a dict of counters and sizes"""
+        self._lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRatio': lookups and float(self.hits) / lookups or 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                }
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
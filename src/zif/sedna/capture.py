@@ -0,0 +1,167 @@
+"""
+Binary capture of the client/server conversation
+
+SednaProtocol.captureOn(filename) writes every message sent and received,
+as is, to filename.  This costs a file write per message and nothing else,
+so it is much cheaper than tracing; the messages are decoded later, off-line:
+
+    from zif.sedna.capture import formatCapture
+    for line in formatCapture('/tmp/sedna.cap'):
+        print line
+
+The file is rotated like logging.handlers.RotatingFileHandler: when it grows
+past maxBytes, it is renamed to filename.1 (filename.1 to filename.2, and so
+on, up to backupCount files) and a new file is started.  Every file starts
+at a message boundary, so each can be read on its own.
+
+A file is a sequence of records: a direction byte ('C' sent by the client,
+'S' sent by the server), the time as a double, and the length of the data
+as an Int, followed by the data: one or more complete messages.
+"""
+
+import os
+import time
+from struct import Struct
+
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
+
+from zif.sedna.codec import HEADER, HEADER_SIZE, DATA_OFFSET, payload
+from zif.sedna.msgcodes import codes, SEDNA_EXECUTE, SEDNA_EXECUTE_LONG,\
+SEDNA_BULKLOAD_PORTION
+
+# direction, time, data length
+RECORD = Struct('!cdI')
+
+CLIENT = b'C'
+SERVER = b'S'
+
+# where the data starts in the body of client messages
+REQUEST_OFFSETS = {
+        SEDNA_EXECUTE : DATA_OFFSET + 1,
+        SEDNA_EXECUTE_LONG : DATA_OFFSET + 1,
+        SEDNA_BULKLOAD_PORTION : DATA_OFFSET,
+        }
+
+
+class FrameCapture(object):
+    """write records of raw messages to a rotating file
+
+    filename     the file to write
+    maxBytes     rotate when the file is this big; 0 never rotates
+    backupCount  the number of rotated files kept
+    """
+
+    def __init__(self,filename,maxBytes=64*1048576,backupCount=5):
+        self.filename = filename
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self._lock = _threading.Lock()
+        self._file = open(filename,'ab')
+        self._size = self._file.tell()
+
+    def write(self,direction,data):
+        """record data, one or more complete messages"""
+        self.writeBuffers(direction,(data,))
+
+    def writeBuffers(self,direction,buffers):
+        """record the concatenation of buffers"""
+        length = 0
+        for buf in buffers:
+            length += len(buf)
+        self._lock.acquire()
+        try:
+            f = self._file
+            if f is None:
+                return
+            if self.maxBytes and self._size and \
+                    self._size + RECORD.size + length > self.maxBytes:
+                self._rotate()
+                f = self._file
+            f.write(RECORD.pack(direction,time.time(),length))
+            for buf in buffers:
+                f.write(buf)
+            self._size += RECORD.size + length
+        finally:
+            self._lock.release()
+
+    def _rotate(self):
+        self._file.close()
+        if self.backupCount > 0:
+            for k in range(self.backupCount - 1,0,-1):
+                source = '%s.%d' % (self.filename,k)
+                if os.path.exists(source):
+                    target = '%s.%d' % (self.filename,k + 1)
+                    if os.path.exists(target):
+                        os.remove(target)
+                    os.rename(source,target)
+            target = self.filename + '.1'
+            if os.path.exists(target):
+                os.remove(target)
+            os.rename(self.filename,target)
+        else:
+            os.remove(self.filename)
+        self._file = open(self.filename,'wb')
+        self._size = 0
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            if self._file is not None:
+                self._file.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        finally:
+            self._lock.release()
+
+
+def readCapture(filename):
+    """yield (direction, time, token, body) for each message in a capture"""
+    f = open(filename,'rb')
+    try:
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                break
+            direction, when, length = RECORD.unpack(record)
+            data = f.read(length)
+            start = 0
+            while start + HEADER_SIZE <= len(data):
+                token, bodylen = HEADER.unpack_from(data,start)
+                start += HEADER_SIZE
+                yield direction, when, token, data[start:start + bodylen]
+                start += bodylen
+    finally:
+        f.close()
+
+def formatCapture(filename,prefix=200):
+    """
+    yield a line of text for each message in a capture, like the trace
+
+    At most prefix bytes of each message's data are shown.
+    """
+    for direction, when, token, body in readCapture(filename):
+        if direction == CLIENT:
+            data = body[REQUEST_OFFSETS.get(token,0):]
+        else:
+            data = payload(token,body)
+        name = codes.get(token,token)
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(when))
+        stamp = '%s.%06d' % (stamp, (when % 1) * 1000000)
+        if data:
+            text = data[:prefix].decode('utf-8','replace')
+            if len(data) > prefix:
+                text += '... [%d bytes]' % len(data)
+            yield '%s (%s) %s %s' % (stamp, direction.decode('ascii'), name,
+                text)
+        else:
+            yield '%s (%s) %s' % (stamp, direction.decode('ascii'), name)
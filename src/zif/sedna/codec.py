@@ -0,0 +1,238 @@
+"""
+Sedna message codec
+
+Encoding and decoding of the messages of the Sedna client/server protocol,
+shared by the protocol implementations in zif.sedna.
+
+A message is a header of two network-order Ints, the token and the length of
+the body, followed by the body.  Strings within a body are sent as a null byte
+and an Int length, followed by the utf-8 encoded string ("zstring").
+
+All formats are compiled once, here, into struct.Struct objects.  Requests are
+packed header-and-prefix in one call, and MessageBuffer packs them into a
+preallocated buffer without building intermediate strings.
+"""
+
+from struct import Struct
+
+from zif.sedna.msgcodes import SEDNA_EXECUTE, SEDNA_EXECUTE_LONG,\
+SEDNA_LONG_QUERY_END, SEDNA_SET_SESSION_OPTIONS,\
+SEDNA_SESSION_PARAMETERS, SEDNA_BULKLOAD_PORTION, SEDNA_ERROR_RESPONSE, SEDNA_DEBUG_INFO,\
+SEDNA_ITEM_PART, SEDNA_LAST_QUERY_TIME, SEDNA_BULKLOAD_FILENAME
+
+SEDNA_VERSION_MAJOR = 3
+SEDNA_VERSION_MINOR = 0
+SEDNA_MAX_BODY_LENGTH = 10240
+
+# token, body length
+HEADER = Struct('!II')
+# null byte, string length
+ZSTRING = Struct('!bi')
+INT = Struct('!I')
+VERSION = Struct('!bb')
+
+# header and the fixed part of common bodies, packed in one go
+# a body that is a single zstring
+HEADER_ZSTRING = Struct('!IIbi')
+# a query: the result format byte, then the query as zstring
+HEADER_EXECUTE = Struct('!IIbbi')
+# a session option: the option Int, then an empty zstring
+HEADER_OPTION = Struct('!IIIbi')
+
+HEADER_SIZE = HEADER.size
+
+# where the data starts in the body of a server message.
+# Data messages are: null byte, Int message length, message: 5
+# Error / debug messages are: Int, null byte, Int message length, message: 9
+DATA_OFFSET = ZSTRING.size
+ERROR_OFFSET = INT.size + ZSTRING.size
+
+# the most data that fits in one zstring message
+MAX_PORTION_LENGTH = SEDNA_MAX_BODY_LENGTH - DATA_OFFSET
+# the most query bytes in an EXECUTE message, after the format byte
+MAX_QUERY_PART_LENGTH = MAX_PORTION_LENGTH - 1
+
+PAYLOAD_OFFSETS = {
+        SEDNA_ITEM_PART : DATA_OFFSET,
+        SEDNA_LAST_QUERY_TIME : DATA_OFFSET,
+        SEDNA_BULKLOAD_FILENAME : DATA_OFFSET,
+        SEDNA_ERROR_RESPONSE : ERROR_OFFSET,
+        SEDNA_DEBUG_INFO : ERROR_OFFSET,
+        }
+
+# encoding
+
+def utf8(aString):
+    """return aString as utf-8 encoded bytes"""
+    if not isinstance(aString,bytes):
+        aString = aString.encode('utf-8')
+    return aString
+
+def zString(aString):
+    """
+    return a string prefixed with null+length in network format
+    """
+    aString = utf8(aString)
+    return ZSTRING.pack(0,len(aString)) + aString
+
+def message(token,body=b''):
+    """return a complete message: header, then body"""
+    return HEADER.pack(token,len(body)) + body
+
+def zStringMessage(token,aString):
+    """return a message whose body is the single zstring aString"""
+    aString = utf8(aString)
+    strlen = len(aString)
+    return HEADER_ZSTRING.pack(token,strlen + DATA_OFFSET,0,strlen) + aString
+
+def executeMessage(query,format=0,token=SEDNA_EXECUTE):
+    """return an EXECUTE (or EXECUTE_LONG) message for (part of) a query"""
+    query = utf8(query)
+    strlen = len(query)
+    return HEADER_EXECUTE.pack(token,strlen + DATA_OFFSET + 1,format,0,
+        strlen) + query
+
+def executeBuffers(query,format=0,size=MAX_QUERY_PART_LENGTH):
+    """
+    return the messages that execute query, a utf-8 encoded str
+
+    return a list alternating message prefixes and data, suitable for a
+    gathering write.  A query with more than size bytes is sent as
+    EXECUTE_LONG parts of at most size bytes followed by LONG_QUERY_END.
+    """
+    strlen = len(query)
+    if strlen <= size:
+        return [HEADER_EXECUTE.pack(SEDNA_EXECUTE,strlen + DATA_OFFSET + 1,
+            format,0,strlen), query]
+    pack = HEADER_EXECUTE.pack
+    view = memoryview(query)
+    buffers = []
+    for start in range(0,strlen,size):
+        part = view[start:start + size]
+        partlen = len(part)
+        buffers.append(pack(SEDNA_EXECUTE_LONG,partlen + DATA_OFFSET + 1,
+            format,0,partlen))
+        buffers.append(part)
+    buffers.append(HEADER.pack(SEDNA_LONG_QUERY_END,0))
+    return buffers
+
+def portions(data,token=SEDNA_BULKLOAD_PORTION,size=MAX_PORTION_LENGTH):
+    """
+    cut data into zstring messages of at most size bytes of data
+
+    return a list alternating message prefixes and memoryview slices of data,
+    suitable for a gathering write.  data is not copied.
+    """
+    view = memoryview(data)
+    datalen = len(view)
+    pack = HEADER_ZSTRING.pack
+    buffers = []
+    for start in range(0,datalen,size):
+        part = view[start:start + size]
+        strlen = len(part)
+        buffers.append(pack(token,strlen + DATA_OFFSET,0,strlen))
+        buffers.append(part)
+    return buffers
+
+def sessionOptionMessage(option):
+    """return a SET_SESSION_OPTIONS message for option"""
+    return HEADER_OPTION.pack(SEDNA_SET_SESSION_OPTIONS,
+        INT.size + DATA_OFFSET,option,0,0)
+
+def sessionParameters(login,db):
+    """return the body of the SESSION_PARAMETERS message"""
+    return VERSION.pack(SEDNA_VERSION_MAJOR,SEDNA_VERSION_MINOR) \
+        + zString(login) + zString(db)
+
+def sessionParametersMessage(login,db):
+    """return the SESSION_PARAMETERS message sent at start-up"""
+    return message(SEDNA_SESSION_PARAMETERS,sessionParameters(login,db))
+
+
+class MessageBuffer(object):
+    """
+    Pack requests into one preallocated buffer.
+
+    Each method returns a memoryview of the buffer holding the complete
+    message.  The view is only good until the next call, so send it right
+    away.  The buffer grows if a message does not fit.
+    """
+    __slots__ = ('buffer','view')
+
+    def __init__(self,size=SEDNA_MAX_BODY_LENGTH):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def _room(self,size):
+        if size > len(self.buffer):
+            self.buffer = bytearray(max(size,2*len(self.buffer)))
+            self.view = memoryview(self.buffer)
+        return self.buffer
+
+    def message(self,token,body=b''):
+        start = HEADER_SIZE
+        end = start + len(body)
+        buf = self._room(end)
+        HEADER.pack_into(buf,0,token,len(body))
+        buf[start:end] = body
+        return self.view[:end]
+
+    def zStringMessage(self,token,aString):
+        aString = utf8(aString)
+        strlen = len(aString)
+        start = HEADER_ZSTRING.size
+        end = start + strlen
+        buf = self._room(end)
+        HEADER_ZSTRING.pack_into(buf,0,token,strlen + DATA_OFFSET,0,strlen)
+        buf[start:end] = aString
+        return self.view[:end]
+
+    def executeMessage(self,query,format=0,token=SEDNA_EXECUTE):
+        query = utf8(query)
+        strlen = len(query)
+        start = HEADER_EXECUTE.size
+        end = start + strlen
+        buf = self._room(end)
+        HEADER_EXECUTE.pack_into(buf,0,token,strlen + DATA_OFFSET + 1,format,
+            0,strlen)
+        buf[start:end] = query
+        return self.view[:end]
+
+# decoding
+
+def payload(token,body):
+    """return the data part of the body of a server message"""
+    offset = PAYLOAD_OFFSETS.get(token,0)
+    if offset:
+        return body[offset:]
+    return body
+
+def normalizeMessage(message):
+    """
+    un-tab and rstrip an informational message
+
+    tab-to-space replacement and rstripping helps with repeatable doctests
+    """
+    message = message.decode('utf-8')
+    n = []
+    for k in message.split('\n'):
+        n.append(k.strip().replace('\t','    '))
+    return '\n'.join(n)
+
+
+class ErrorInfo(object):
+    __slots__ = ('code','info')
+    def __init__(self,msg):
+        #first Int is the code.
+        self.code, = INT.unpack_from(msg)
+        # two Ints and a byte = 9
+        # normalize the info so it works reliably in doctests.
+        self.info = "[%s] %s" % (self.code,
+            normalizeMessage(msg[ERROR_OFFSET:].strip()))
+
+
+class DebugInfo(ErrorInfo):
+    __slots__ = ()
+    def __init__(self,msg):
+        self.code = None
+        self.info = "%s" % normalizeMessage(msg[ERROR_OFFSET:].strip())
@@ -1,9 +1,5 @@
 import time, random
 
-try:
-    import threading as _threading
-except ImportError:
-    import dummy_threading as _threading
 try:
     import thread as _thread
 except ImportError:
@@ -25,8 +21,6 @@ connectionPool = pool.manage(dbapi)
 
 #connectionPool = pool.manage(dbapi,poolclass=pool.SingletonThreadPool)
 
-lock = _threading.Lock()
-
 DEFAULT_ENCODING = 'utf-8'
 
 class SednaTypeInfo(object):
@@ -106,12 +100,18 @@ class SednaAdapter(object):
                 time.time(), random.random(), _thread.get_ident()
                 )
 
+    _pool = None
+
     def _connection_factory(self):
-        return connectionPool.connect(self.dsn)
+        pool = self._pool
+        if pool is None:
+            pool = self._pool = connectionPool.get_pool(self.dsn)
+        return pool.connect()
 
     def setDSN(self, dsn):
         assert dsn.startswith('dbi://'), "The DSN has to start with 'dbi://'"
         self.dsn = dsn
+        self._pool = None
 
     def getDSN(self):
         return self.dsn
@@ -129,16 +129,15 @@ class SednaAdapter(object):
 
     def __call__(self):
         """
-        we lock so other threads cannot get a connection while this
-        thread is getting a connection.  Two threads will not get the same
-        connection, presumably.
+        return a connection for this thread.
+
+        The pool hands out a different connection to each thread, so there
+        is no lock here.  The connection is kept in a local, because another
+        thread may set self.connection meanwhile.
         """
-        lock.acquire()
-        try:
-            self.connect()
-        finally:
-            lock.release()
-        return self.connection
+        connection = SednaConnection(self._connection_factory(), self)
+        self.connection = connection
+        return connection
 
     # Pessimistic defaults
     paramstyle = 'pyformat'
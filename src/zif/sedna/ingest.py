@@ -0,0 +1,251 @@
+"""
+Parallel bulk loading of many documents
+
+bulk_ingest loads a stream of (name, source) pairs into the database, using
+several connections at once.
+
+    from zif.sedna.ingest import bulk_ingest
+    report = bulk_ingest(documents, collection='books', workers=8,
+        host='localhost', db='test', login='SYSTEM', passwd='MANAGER')
+    failed = [r for r in report if not r.loaded]
+
+documents is any iterable of (name, source) pairs.  source is anything
+SednaProtocol.loadText accepts: a string, a file-like object or mmap, or an
+iterable of strings.  The iterable is consumed as the workers need more, so
+it may be a generator over a very large number of documents.
+
+Each worker checks out a connection from a zif.sedna.pool QueuePool (or
+from the pool you pass in) and loads batch_size documents per transaction.
+
+When a connection fails (InterfaceError or OperationalError), it is
+discarded, and the batch is tried again on a new connection, up to retries
+times.  When the database refuses a document (DatabaseError), the batch is
+rolled back and its documents are loaded one per transaction, so that the
+error is reported for the right document and the others still load.
+
+A source can only be sent again if it is a string or a seekable file.  Other
+sources are reported as failed when they would need a retry.
+
+bulk_ingest returns one IngestResult per document, in the order of
+documents.
+"""
+
+import time
+
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
+import Queue
+
+from zif.sedna.protocol import SednaProtocol
+from zif.sedna.pool import QueuePool
+from zif.sedna.dbapiexceptions import InterfaceError, OperationalError,\
+DatabaseError
+
+# errors after which a connection is not trusted any more
+TRANSIENT_ERRORS = (InterfaceError, OperationalError)
+
+class IngestResult(object):
+    """the outcome of loading one document
+
+    name      the document name
+    loaded    True if the document was committed
+    error     the error message if the document was not loaded, else None
+    attempts  the number of times the document was sent
+    """
+    __slots__ = ('name','loaded','error','attempts')
+
+    def __init__(self,name):
+        self.name = name
+        self.loaded = False
+        self.error = None
+        self.attempts = 0
+
+    def __repr__(self):
+        if self.loaded:
+            state = 'loaded'
+        else:
+            state = 'failed: %s' % self.error
+        return '<IngestResult %s %s>' % (self.name, state)
+
+
+class _Document(object):
+    __slots__ = ('result','source','position')
+
+    def __init__(self,name,source):
+        self.result = IngestResult(name)
+        self.source = source
+        self.position = None
+        if not isinstance(source,basestring):
+            try:
+                self.position = source.tell()
+            except (AttributeError, IOError):
+                pass
+
+    def rewind(self):
+        """make the source ready to be sent (again). False if it cannot be"""
+        if self.result.attempts == 0 or isinstance(self.source,basestring):
+            return True
+        if self.position is None:
+            return False
+        try:
+            self.source.seek(self.position)
+        except (AttributeError, IOError):
+            return False
+        return True
+
+
+def _rollback(conn):
+    """roll back, ignoring complaints; the transaction may be gone already"""
+    if conn.inTransaction:
+        try:
+            conn.rollback()
+        except DatabaseError:
+            pass
+
+
+class _Worker(object):
+    def __init__(self,pool,batches,collection,retries,delay):
+        self.pool = pool
+        self.batches = batches
+        self.collection = collection
+        self.retries = retries
+        self.delay = delay
+        self.conn = None
+
+    def run(self):
+        try:
+            while True:
+                batch = self.batches.get()
+                if batch is None:
+                    break
+                self.loadBatch(batch)
+        finally:
+            if self.conn is not None:
+                _rollback(self.conn)
+                self.conn.close()
+                self.conn = None
+
+    def connection(self):
+        if self.conn is None:
+            self.conn = self.pool.connect()
+        return self.conn
+
+    def discard(self,e):
+        if self.conn is not None:
+            try:
+                self.conn.invalidate(e)
+            except DatabaseError:
+                pass
+            self.conn = None
+
+    def send(self,docs):
+        """load docs in one transaction, retrying on transient errors
+
+        return True when committed.  DatabaseError is raised when the
+        database refuses a document.
+        """
+        attempt = 0
+        while True:
+            for doc in docs:
+                if not doc.rewind():
+                    raise DatabaseError(
+                        'source cannot be sent again: %s' % doc.result.name)
+            try:
+                conn = self.connection()
+                for doc in docs:
+                    doc.result.attempts += 1
+                    conn.loadText(doc.source,doc.result.name,
+                        self.collection)
+                conn.commit()
+                return True
+            except TRANSIENT_ERRORS as e:
+                self.discard(e)
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                time.sleep(self.delay * attempt)
+            except DatabaseError:
+                if self.conn is not None:
+                    _rollback(self.conn)
+                raise
+
+    def loadBatch(self,docs):
+        try:
+            self.send(docs)
+        except TRANSIENT_ERRORS as e:
+            self.fail(docs,e)
+        except DatabaseError as e:
+            if len(docs) == 1:
+                self.fail(docs,e)
+            else:
+                # find the document(s) at fault by loading them one at a time
+                for doc in docs:
+                    self.loadBatch([doc])
+        except Exception as e:
+            # keep the worker going; the connection is in an unknown state
+            self.discard(e)
+            self.fail(docs,e)
+        else:
+            for doc in docs:
+                doc.result.loaded = True
+
+    def fail(self,docs,e):
+        for doc in docs:
+            doc.result.error = str(e)
+
+
+def bulk_ingest(documents,collection=None,workers=4,batch_size=50,
+        retries=3,retry_delay=0.5,pool=None,host='localhost',db="test",
+        login="SYSTEM",passwd="MANAGER",port=5050):
+    """
+    load (name, source) pairs from documents, workers connections at a time
+
+    collection      put the documents in this collection
+    workers         the number of connections loading at once
+    batch_size      the number of documents committed per transaction
+    retries         how often a batch is tried again after a connection error
+    retry_delay     seconds to wait before the first retry; later retries
+                    wait proportionally longer
+    pool            a zif.sedna.pool Pool of SednaProtocol connections.  If
+                    not provided, a QueuePool of workers connections to
+                    host, db, login, passwd, port is used and disposed of
+                    afterwards.
+
+    return a list of IngestResult, one per document, in the order given.
+    """
+    ownPool = pool is None
+    if ownPool:
+        def creator():
+            return SednaProtocol(host,db,login,passwd,port)
+        pool = QueuePool(creator,pool_size=workers,max_overflow=0)
+    # a bounded queue, so documents are read only as fast as they load
+    batches = Queue.Queue(2 * workers)
+    threads = []
+    for k in range(workers):
+        worker = _Worker(pool,batches,collection,retries,retry_delay)
+        thread = _threading.Thread(target=worker.run)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    results = []
+    try:
+        batch = []
+        for name, source in documents:
+            doc = _Document(name,source)
+            results.append(doc.result)
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                batches.put(batch)
+                batch = []
+        if batch:
+            batches.put(batch)
+    finally:
+        for thread in threads:
+            batches.put(None)
+        for thread in threads:
+            thread.join()
+        if ownPool:
+            pool.dispose()
+    return results
@@ -1,4 +1,3 @@
-from struct import pack, unpack, calcsize
 from datetime import datetime
 import sys
 
@@ -15,6 +14,9 @@ from Kamaelia.Util.OneShot import OneShot
 from Axon.CoordinatingAssistantTracker import coordinatingassistanttracker
 
 import zif.sedna.msgcodes as se
+from zif.sedna.codec import HEADER, PAYLOAD_OFFSETS, message, executeMessage,\
+sessionOptionMessage, sessionParameters
+from zif.sedna import codec
 
 #errfile = sys.stderr
 
@@ -35,12 +37,12 @@ config_used = "DEFAULT_INTERNAL"
 
 ZSTRING_FORMAT = '>bi%ss'
 BYTE_FORMAT = '>b'
-VERS_FORMAT = '>bb'
-VERSION_MAJOR = 3
-VERSION_MINOR = 0
-MAX_MSG_SIZE = 10240
-HEADER_FORMAT = ">II"
-LONGINT_FORMAT = ">I"
+VERS_FORMAT = codec.VERSION.format
+VERSION_MAJOR = codec.SEDNA_VERSION_MAJOR
+VERSION_MINOR = codec.SEDNA_VERSION_MINOR
+MAX_MSG_SIZE = codec.SEDNA_MAX_BODY_LENGTH
+HEADER_FORMAT = HEADER.format
+LONGINT_FORMAT = codec.INT.format
 
 class TransactionFailed(Exception):
     pass
@@ -50,11 +52,7 @@ class RollbackFailed(Exception):
 
 # Error / debug messages are: Int, null byte, Int message length, message: 9
 # Data messages are: null byte, Int message length, message: 5
-headersizes = {se.SEDNA_ITEM_PART: 5,
-             se.SEDNA_LAST_QUERY_TIME: 5,
-             se.SEDNA_BULKLOAD_FILENAME: 5,
-             se.SEDNA_ERROR_RESPONSE: 9,
-             se.SEDNA_DEBUG_INFO: 9} 
+headersizes = PAYLOAD_OFFSETS
 
 def responseheaderlength(token):
     """
@@ -66,15 +64,7 @@ def responseheaderlength(token):
     except KeyError:
         return 0
 
-def zstring(aString):
-    """
-    return a string prefixed with null+length in network format
-    """
-    #first, make sure it is a bytestring in utf-8
-    if isinstance(aString, unicode):
-        aString = aString.encode('utf-8')
-    length = len(aString)
-    return pack('>bi%ss' % length, 0, length, aString)
+zstring = codec.zString
 
 class SednaMessage(object):
     __slots__ = ('code', 'msg')
@@ -210,7 +200,7 @@ class AuthenticatedSednaCursor(component):
                 if header is None:
                     # Return None here so main() gets more data.
                     return
-                token, msg_length = unpack(">II", header)
+                token, msg_length = HEADER.unpack(header)
                 msg = self.getbytes(msg_length)
                 if msg is None:
                     # Return None here so main() gets more data.
@@ -248,13 +238,11 @@ class AuthenticatedSednaCursor(component):
         code, data = msg.code, msg.msg
         if code in self.executecodes:
             # queries need to ask for return format
-            data = pack('>b', self.format) + zstring(data)
-        
+            return executeMessage(data, self.format, int(code))
         elif code == se.SEDNA_SET_SESSION_OPTIONS:
             # session options have a different format
-            data = pack(">I", msg) + zstring('')
-        
-        return pack(">II", int(code), len(data)) + data
+            return sessionOptionMessage(data)
+        return message(int(code), data)
 
 
     def main(self):
@@ -327,11 +315,8 @@ class AuthenticatedSednaCursor(component):
     def sendSessionParameters(self, msg):
         self.connected = True
         token = se.SEDNA_SESSION_PARAMETERS
-        msg = (pack(VERS_FORMAT, VERSION_MAJOR, 
-                   VERSION_MINOR) 
-            + zstring(self.login.encode('utf-8')) 
-            + zstring(self.db.encode('utf-8')))
-        self.request(SednaRequest(token, msg))     
+        msg = sessionParameters(self.login, self.db)
+        self.request(SednaRequest(token, msg))
     
     def sendAuthParameters(self, msg):
         token = se.SEDNA_AUTHENTICATION_PARAMETERS
@@ -0,0 +1,251 @@
+"""
+Connection pool metrics
+
+A PoolMetrics collects what a zif.sedna.pool Pool does: how long callers
+wait to check out a connection, how many connections are created,
+invalidated and recycled, overflow and timeouts, and how many queries each
+connection runs.  Give it to the pool:
+
+    from zif.sedna.metrics import PoolMetrics, PrometheusExporter
+    metrics = PoolMetrics()
+    pool = QueuePool(creator, pool_size=5, metrics=metrics)
+
+snapshot() returns the numbers as a dict, with the current in-use and idle
+connections and overflow of the pool.  An exporter formats a snapshot for
+a monitoring system:
+
+    text = metrics.export(PrometheusExporter(labels={'db': 'test'}))
+
+Per-connection query counts come from the queryCount attribute of the
+connections, which SednaProtocol keeps.  Connections without it are not
+counted.
+
+Collecting costs a lock and a few additions per checkout and checkin.
+"""
+
+import time
+import weakref
+from bisect import bisect_left
+
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
+
+# upper bounds, in seconds, of the checkout wait histogram buckets
+WAIT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+    0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# the event counters, and what they count
+COUNTERS = (
+    ('checkouts', 'Connections checked out.'),
+    ('checkins', 'Connections checked in.'),
+    ('created', 'Connections opened.'),
+    ('connectErrors', 'Failed attempts to open a connection.'),
+    ('invalidated', 'Connections invalidated after an error.'),
+    ('recycled', 'Connections reopened because they were too old.'),
+    ('discarded', 'Idle connections closed by the pool.'),
+    ('overflows', 'Connections opened beyond pool_size.'),
+    ('timeouts', 'Checkouts that gave up waiting for a connection.'),
+    ('queries', 'Queries run on checked-in connections.'),
+    )
+
+# the gauges, with the pool method or attribute that reads each
+GAUGES = (
+    ('size', 'size', 'Connections kept in the pool.'),
+    ('idle', 'checkedin', 'Idle connections in the pool.'),
+    ('inUse', 'checkedout', 'Connections checked out.'),
+    ('overflow', 'overflow', 'Connections open beyond pool_size.'),
+    )
+
+
+class Histogram(object):
+    """counts of observed values, by upper bound"""
+    __slots__ = ('bounds','counts','count','sum')
+
+    def __init__(self,bounds):
+        self.bounds = tuple(bounds)
+        # the last count is for values beyond the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self,value):
+        self.counts[bisect_left(self.bounds,value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        """return a dict with the cumulative buckets, count and sum"""
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds,self.counts):
+            total += count
+            buckets.append((bound,total))
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+
+class PoolMetrics(object):
+    """metrics of one pool
+
+    buckets    the upper bounds, in seconds, of the checkout wait histogram
+    """
+
+    def __init__(self,buckets=WAIT_BUCKETS):
+        self._lock = _threading.Lock()
+        self.wait = Histogram(buckets)
+        self.counters = dict((name, 0) for name, doc in COUNTERS)
+        # connection record: the queryCount seen at its last checkin
+        self._queries = weakref.WeakKeyDictionary()
+        self._pool = None
+
+    def bind(self,pool):
+        """called by the pool; the gauges are read from it"""
+        self._pool = weakref.ref(pool)
+
+    # called by the pool
+
+    def count(self,name,n=1):
+        self._lock.acquire()
+        try:
+            self.counters[name] += n
+        finally:
+            self._lock.release()
+
+    def checkedOut(self,wait):
+        self._lock.acquire()
+        try:
+            self.counters['checkouts'] += 1
+            self.wait.observe(wait)
+        finally:
+            self._lock.release()
+
+    def checkedIn(self,record):
+        connection = record.connection
+        queries = getattr(connection,'queryCount',None)
+        self._lock.acquire()
+        try:
+            self.counters['checkins'] += 1
+            if queries is not None:
+                last = self._queries.get(record,0)
+                if queries < last:
+                    # a new connection in the same record
+                    last = 0
+                self.counters['queries'] += queries - last
+                self._queries[record] = queries
+        finally:
+            self._lock.release()
+
+    # reading
+
+    def snapshot(self):
+        """return a dict of the counters, gauges and histogram
+
+        'wait' is the checkout wait histogram, a dict with 'buckets', a list
+        of (upper bound, cumulative count), 'count' and 'sum'.
+        'connectionQueries' lists the queries run by each open connection.
+        Gauges the pool does not have are left out.
+
+        >>> from zif.sedna.pool import SingletonThreadPool
+        >>> metrics = PoolMetrics()
+        >>> pool = SingletonThreadPool(lambda: None, pool_size=3,
+        ...     metrics=metrics)
+        >>> snapshot = metrics.snapshot()
+        >>> snapshot['size'], snapshot['checkouts'], 'idle' in snapshot
+        (3, 0, False)
+        """
+        self._lock.acquire()
+        try:
+            snapshot = dict(self.counters)
+            snapshot['wait'] = self.wait.snapshot()
+            snapshot['connectionQueries'] = [count for record, count in
+                self._queries.items() if record.connection is not None]
+        finally:
+            self._lock.release()
+        pool = self._pool and self._pool()
+        for name, attribute, doc in GAUGES:
+            value = getattr(pool,attribute,None)
+            if callable(value):
+                value = value()
+            if value is not None:
+                snapshot[name] = value
+        return snapshot
+
+    def export(self,exporter):
+        """return the snapshot formatted by exporter"""
+        return exporter.export(self.snapshot())
+
+
+class Exporter(object):
+    """formats a PoolMetrics snapshot; subclasses implement export"""
+
+    def export(self,snapshot):
+        raise NotImplementedError
+
+
+def _metricName(name):
+    """checkoutWait -> checkout_wait"""
+    out = []
+    for c in name:
+        if c.isupper():
+            out.append('_')
+        out.append(c.lower())
+    return ''.join(out)
+
+def _labelText(labels,extra=()):
+    pairs = sorted(labels.items()) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\','\\\\')
+        .replace('"','\\"').replace('\n','\\n')) for k, v in pairs)
+
+def _number(value):
+    if isinstance(value,float):
+        return repr(value)
+    return str(value)
+
+
+class PrometheusExporter(Exporter):
+    """the Prometheus text exposition format
+
+    prefix    the start of every metric name
+    labels    a dict of labels added to every sample, e.g. to tell pools
+              apart
+    """
+
+    def __init__(self,prefix='zif_sedna_pool',labels=None):
+        self.prefix = prefix
+        self.labels = labels or {}
+
+    def export(self,snapshot):
+        lines = []
+        labels = self.labels
+        for name, doc in COUNTERS:
+            metric = '%s_%s_total' % (self.prefix, _metricName(name))
+            lines.append('# HELP %s %s' % (metric, doc))
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s%s %s' % (metric, _labelText(labels),
+                snapshot[name]))
+        for name, method, doc in GAUGES:
+            if name not in snapshot:
+                continue
+            metric = '%s_%s' % (self.prefix, _metricName(name))
+            lines.append('# HELP %s %s' % (metric, doc))
+            lines.append('# TYPE %s gauge' % metric)
+            lines.append('%s%s %s' % (metric, _labelText(labels),
+                snapshot[name]))
+        wait = snapshot['wait']
+        metric = '%s_checkout_wait_seconds' % self.prefix
+        lines.append('# HELP %s Time waited to check out a connection.'
+            % metric)
+        lines.append('# TYPE %s histogram' % metric)
+        for bound, count in wait['buckets']:
+            lines.append('%s_bucket%s %s' % (metric,
+                _labelText(labels,[('le', _number(float(bound)))]), count))
+        lines.append('%s_bucket%s %s' % (metric,
+            _labelText(labels,[('le', '+Inf')]), wait['count']))
+        lines.append('%s_sum%s %s' % (metric, _labelText(labels),
+            _number(wait['sum'])))
+        lines.append('%s_count%s %s' % (metric, _labelText(labels),
+            wait['count']))
+        return '\n'.join(lines) + '\n'
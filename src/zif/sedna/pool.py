@@ -41,6 +41,10 @@ except ImportError:
 
 proxies = {}
 
+# __jmw__ sqlalchemy.exceptions.TimeoutError
+class TimeoutError(OperationalError):
+    """No connection became available within the pool's timeout."""
+
 def manage(module, **params):
     """Return a proxy for a DB-API module that automatically pools connections.
 
@@ -84,6 +88,10 @@ class Pool(object):
     QueuePool
       Pools multiple connections using ``Queue.Queue``.
 
+    SednaQueuePool
+      A QueuePool that opens connections ahead of demand and pings idle
+      connections.
+
     SingletonThreadPool
       Stores a single connection per execution thread.
 
@@ -126,10 +134,15 @@ class Pool(object):
       A list of ``PoolListener``-like objects that receive events when
       DB-API connections are created, checked out and checked in to
       the pool.
+
+    metrics
+      A ``zif.sedna.metrics.PoolMetrics`` that collects checkout wait
+      times, counts of connections created, invalidated and recycled, and
+      other numbers.  Defaults to None, collecting nothing.
     """
 
     def __init__(self, creator, recycle=-1, echo=None, use_threadlocal=True,
-                 listeners=None):
+                 listeners=None, metrics=None):
         self.logger = logging.getLogger()
         # the WeakValueDictionary works more nicely than a regular dict
         # of weakrefs.  the latter can pile up dead reference objects which don't
@@ -144,6 +157,9 @@ class Pool(object):
         self._on_checkout = []
         self._on_checkin = []
         self._should_log_info = False
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.bind(self)
         if listeners:
             for l in listeners:
                 self.add_listener(l)
@@ -188,10 +204,21 @@ class Pool(object):
         if self._use_threadlocal and _thread.get_ident() in self._threadconns:
             #__jmw__ _thread instead of thread
             del self._threadconns[_thread.get_ident()]
+        if self.metrics is not None:
+            self.metrics.checkedIn(record)
         self.do_return_conn(record)
 
     def get(self):
-        return self.do_get()
+        if self.metrics is None:
+            return self.do_get()
+        start = time.time()
+        try:
+            conn = self.do_get()
+        except TimeoutError:
+            self.metrics.count('timeouts')
+            raise
+        self.metrics.checkedOut(time.time() - start)
+        return conn
 
     def do_get(self):
         raise NotImplementedError()
@@ -217,6 +244,9 @@ class Pool(object):
         self.logger.info(msg)
 
 class _ConnectionRecord(object):
+    # __jmw__ so __del__ works when connecting fails in __init__
+    connection = None
+
     def __init__(self, pool):
         self.__pool = pool
         self.connection = self.__connect()
@@ -246,6 +276,8 @@ class _ConnectionRecord(object):
                                 (self.connection, e.__class__.__name__, e))
             else:
                 self.__pool.log("Invalidate connection %r" % self.connection)
+        if self.__pool.metrics is not None:
+            self.__pool.metrics.count('invalidated')
         self.__close()
         self.connection = None
 
@@ -260,6 +292,8 @@ class _ConnectionRecord(object):
             if self.__pool._should_log_info:
                 self.__pool.log("Connection %r exceeded timeout; recycling" %
                                 self.connection)
+            if self.__pool.metrics is not None:
+                self.__pool.metrics.count('recycled')
             self.__close()
             self.connection = self.__connect()
             self.info.clear()
@@ -286,10 +320,14 @@ class _ConnectionRecord(object):
             connection = self.__pool._creator()
             if self.__pool._should_log_info:
                 self.__pool.log("Created new connection %r" % connection)
+            if self.__pool.metrics is not None:
+                self.__pool.metrics.count('created')
             return connection
         except Exception, e:
             if self.__pool._should_log_info:
                 self.__pool.log("Error on connect(): %s" % e)
+            if self.__pool.metrics is not None:
+                self.__pool.metrics.count('connectErrors')
             raise
 
     properties = property(lambda self: self.info,
@@ -500,7 +538,7 @@ class SingletonThreadPool(Pool):
 
     def recreate(self):
         self.log("Pool recreating")
-        return SingletonThreadPool(self._creator, pool_size=self.size, recycle=self._recycle, echo=self._should_log_info, use_threadlocal=self._use_threadlocal, listeners=self.listeners)
+        return SingletonThreadPool(self._creator, pool_size=self.size, recycle=self._recycle, echo=self._should_log_info, use_threadlocal=self._use_threadlocal, listeners=self.listeners, metrics=self.metrics)
 
     def dispose(self):
         """Dispose of this pool.
@@ -599,7 +637,7 @@ class QueuePool(Pool):
 
     def recreate(self):
         self.log("Pool recreating")
-        return QueuePool(self._creator, pool_size=self._pool.maxsize, max_overflow=self._max_overflow, timeout=self._timeout, recycle=self._recycle, echo=self._should_log_info, use_threadlocal=self._use_threadlocal, listeners=self.listeners)
+        return QueuePool(self._creator, pool_size=self._pool.maxsize, max_overflow=self._max_overflow, timeout=self._timeout, recycle=self._recycle, echo=self._should_log_info, use_threadlocal=self._use_threadlocal, listeners=self.listeners, metrics=self.metrics)
 
     def do_return_conn(self, conn):
         try:
@@ -623,7 +661,7 @@ class QueuePool(Pool):
                 if not wait:
                     return self.do_get()
                 else:
-                    raise exceptions.TimeoutError("QueuePool limit of size %d overflow %d reached, connection timed out, timeout %d" % (self.size(), self.overflow(), self._timeout))
+                    raise TimeoutError("QueuePool limit of size %d overflow %d reached, connection timed out, timeout %s" % (self.size(), self.overflow(), self._timeout))
 
             if self._overflow_lock is not None:
                 self._overflow_lock.acquire()
@@ -633,13 +671,23 @@ class QueuePool(Pool):
                     self._overflow_lock.release()
                 return self.do_get()
 
+            # __jmw__ count the connection before making it, so the lock is
+            # not held while connecting.
+            self._overflow += 1
+            overflowed = self._overflow > 0
+            if self._overflow_lock is not None:
+                self._overflow_lock.release()
+            if overflowed and self.metrics is not None:
+                self.metrics.count('overflows')
             try:
-                con = self.create_connection()
-                self._overflow += 1
-            finally:
+                return self.create_connection()
+            except:
+                if self._overflow_lock is not None:
+                    self._overflow_lock.acquire()
+                self._overflow -= 1
                 if self._overflow_lock is not None:
                     self._overflow_lock.release()
-            return con
+                raise
 
     def dispose(self):
         while True:
@@ -669,6 +717,182 @@ class QueuePool(Pool):
     def checkedout(self):
         return self._pool.maxsize - self._pool.qsize() + self._overflow
 
+# __jmw__ added SednaQueuePool
+class SednaQueuePool(QueuePool):
+    """A QueuePool that keeps connections warm and checks them before use.
+
+    A background thread opens connections ahead of demand, so callers do
+    not wait for the socket connect and the Sedna start-up, authentication
+    exchange.  It also pings the idle connections and replaces the broken
+    ones, so a dead connection is not handed out.  Connections must have a
+    ping() method that raises an exception when the connection is broken,
+    like SednaProtocol.
+
+    Arguments include all those used by QueuePool, as well as:
+
+    min_idle
+      The number of idle connections kept open, up to pool_size.
+      Defaults to 0: no connections are opened ahead of demand.
+
+    ping_interval
+      Connections idle for this many seconds or more are pinged before
+      they are checked out, and by the background thread.  A broken one
+      is replaced by a new connection.  0 pings on every checkout, -1
+      never pings.  Defaults to 30.
+
+    max_idle
+      Connections idle for this many seconds or more are closed by the
+      background thread, down to min_idle connections.  -1 keeps them.
+      Defaults to -1.
+
+    maintenance_interval
+      The number of seconds between runs of the background thread.
+      Defaults to 5.
+    """
+
+    def __init__(self, creator, min_idle=0, ping_interval=30, max_idle=-1,
+                 maintenance_interval=5, **params):
+        QueuePool.__init__(self, creator, **params)
+        self._min_idle = min(min_idle, self.size())
+        self._ping_interval = ping_interval
+        self._max_idle = max_idle
+        self._maintenance_interval = maintenance_interval
+        self._stop = _threading.Event()
+        self._maintainer = None
+        if self._min_idle > 0 or ping_interval > -1 or max_idle > -1:
+            # the thread only holds a weak reference, so an abandoned pool
+            # may still be collected.
+            self._maintainer = _threading.Thread(target=_maintain,
+                args=(weakref.ref(self), self._stop, maintenance_interval))
+            self._maintainer.setDaemon(True)
+            self._maintainer.start()
+
+    def recreate(self):
+        self.log("Pool recreating")
+        return SednaQueuePool(self._creator, min_idle=self._min_idle, ping_interval=self._ping_interval, max_idle=self._max_idle, maintenance_interval=self._maintenance_interval, pool_size=self._pool.maxsize, max_overflow=self._max_overflow, timeout=self._timeout, recycle=self._recycle, echo=self._should_log_info, use_threadlocal=self._use_threadlocal, listeners=self.listeners, metrics=self.metrics)
+
+    def do_return_conn(self, conn):
+        conn.lastused = time.time()
+        QueuePool.do_return_conn(self, conn)
+
+    def get(self):
+        conn = QueuePool.get(self)
+        if self._ping_interval > -1 and conn.connection is not None and \
+                time.time() - self._idle_since(conn) >= self._ping_interval:
+            # a broken connection is reopened when the caller gets it
+            self._ping(conn)
+        return conn
+
+    def dispose(self):
+        self._stop.set()
+        if self._maintainer is not None and \
+                self._maintainer is not _threading.currentThread():
+            self._maintainer.join()
+        QueuePool.dispose(self)
+
+    def _idle_since(self, conn):
+        return getattr(conn, 'lastused', conn.starttime)
+
+    def _ping(self, conn):
+        """ping the connection of record conn.  Invalidate it if broken."""
+        try:
+            conn.connection.ping()
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception, e:
+            if self._should_log_info:
+                self.log("Connection %r failed ping" % conn.connection)
+            conn.invalidate(e)
+            return False
+        conn.lastused = time.time()
+        return True
+
+    def _add_overflow(self, n, limit=None):
+        """add n to the overflow count, unless it is at limit already"""
+        if self._overflow_lock is not None:
+            self._overflow_lock.acquire()
+        try:
+            if limit is not None and self._overflow >= limit:
+                return False
+            self._overflow += n
+            return True
+        finally:
+            if self._overflow_lock is not None:
+                self._overflow_lock.release()
+
+    def _discard(self, conn):
+        """close the idle record conn for good"""
+        conn.close()
+        conn.connection = None
+        self._add_overflow(-1)
+        if self.metrics is not None:
+            self.metrics.count('discarded')
+
+    def maintain(self):
+        """check the idle connections, then open more up to min_idle.
+
+        This runs in the background thread; all the network I/O happens
+        here rather than in the threads that check out connections.
+        """
+        now = time.time()
+        # look at each idle connection once. While one is out of the
+        # queue, callers get the others, or make a new one.
+        for k in range(self._pool.qsize()):
+            try:
+                conn = self._pool.get(False)
+            except Queue.Empty:
+                break
+            try:
+                idle = now - self._idle_since(conn)
+                if conn.connection is not None and self._max_idle > -1 and \
+                        idle >= self._max_idle and \
+                        self._pool.qsize() >= self._min_idle:
+                    self._discard(conn)
+                    continue
+                if conn.connection is not None and \
+                        self._ping_interval > -1 and \
+                        idle >= self._ping_interval:
+                    self._ping(conn)
+                # reopens invalidated connections, and recycles old ones
+                conn.get_connection()
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception, e:
+                if self._should_log_info:
+                    self.log("Error reconnecting in maintenance: %s" % e)
+                self._discard(conn)
+                continue
+            # back in the queue, without counting as used
+            QueuePool.do_return_conn(self, conn)
+        while self._pool.qsize() < self._min_idle:
+            # count the new connection first, so callers cannot exceed
+            # pool_size + max_overflow meanwhile
+            if not self._add_overflow(1, limit=0):
+                break
+            try:
+                conn = self.create_connection()
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception, e:
+                # the server may be down; try again on the next run
+                if self._should_log_info:
+                    self.log("Error warming connection: %s" % e)
+                self._add_overflow(-1)
+                break
+            self.do_return_conn(conn)
+
+def _maintain(poolref, stop, interval):
+    while not stop.isSet():
+        pool = poolref()
+        if pool is None:
+            break
+        try:
+            pool.maintain()
+        except Exception:
+            pool.logger.exception("Pool maintenance failed")
+        del pool
+        stop.wait(interval)
+
 class NullPool(Pool):
     """A Pool which does not pool connections.
 
@@ -770,6 +994,8 @@ class _DBProxy(object):
         self.params = params
         self.poolclass = poolclass
         self.pools = {}
+        # __jmw__ only taken to make a new pool
+        self._create_lock = _threading.Lock()
 
     def close(self):
         for key in self.pools.keys():
@@ -786,9 +1012,17 @@ class _DBProxy(object):
         try:
             return self.pools[key]
         except KeyError:
-            pool = self.poolclass(lambda: self.module.connect(*args, **params), **self.params)
-            self.pools[key] = pool
-            return pool
+            self._create_lock.acquire()
+            try:
+                # another thread may have made it meanwhile
+                try:
+                    return self.pools[key]
+                except KeyError:
+                    pool = self.poolclass(lambda: self.module.connect(*args, **params), **self.params)
+                    self.pools[key] = pool
+                    return pool
+            finally:
+                self._create_lock.release()
 
     def connect(self, *args, **params):
         """Activate a connection to the database.
@@ -815,4 +1049,14 @@ class _DBProxy(object):
             pass
 
     def _serialize(self, *args, **params):
-        return pickle.dumps([args, params])
+        # __jmw__ a tuple is much cheaper than a pickle, and does as well
+        # for the usual DSN string
+        if params:
+            key = (args, tuple(sorted(params.items())))
+        else:
+            key = args
+        try:
+            hash(key)
+        except TypeError:
+            return pickle.dumps([args, params])
+        return key
@@ -49,13 +49,11 @@ Usage:
 """
 
 import socket
-from struct import pack, unpack, calcsize
+from collections import deque
+import codecs
+import re
 import time
-
-
-from io import StringIO
-
-#    from StringIO import StringIO
+import random
 
 try:
     import threading as _threading
@@ -90,21 +88,90 @@ from zif.sedna.dbapiexceptions import Error, Warning, InterfaceError, DatabaseEr
 InternalError, OperationalError, ProgrammingError, IntegrityError,\
 DataError, NotSupportedError
 
-SEDNA_VERSION_MAJOR = 3
-SEDNA_VERSION_MINOR = 0
-SEDNA_MAX_BODY_LENGTH = 10240
-
-LOAD_BUFFER_SIZE = SEDNA_MAX_BODY_LENGTH / 2
+# message encoding and decoding
+from zif.sedna.codec import SEDNA_VERSION_MAJOR, SEDNA_VERSION_MINOR,\
+SEDNA_MAX_BODY_LENGTH, HEADER, HEADER_SIZE, DATA_OFFSET, MessageBuffer,\
+zString, portions, executeBuffers, sessionOptionMessage, sessionParametersMessage, payload,\
+normalizeMessage, ErrorInfo, DebugInfo
+
+# opt-in result cache
+from zif.sedna.cache import isCacheable, normalizeQuery
+
+# opt-in query profiling
+from zif.sedna.querystats import QueryStats
+
+# binary capture of the conversation
+from zif.sedna.capture import FrameCapture, CLIENT, SERVER
+
+LOAD_BUFFER_SIZE = SEDNA_MAX_BODY_LENGTH // 2
+
+# initial size of the per-connection receive buffer.  Several maximum-size
+# server messages fit, so one recv usually picks up many messages.
+RECEIVE_BUFFER_SIZE = 65536
+
+# default upper bound for the bytes a prefetching result holds in memory
+PREFETCH_BUFFER_SIZE = 1048576
+
+# bulk loads read files this much at a time
+BULKLOAD_READ_SIZE = 1048576
+
+# the most buffers handed to a single sendmsg call
+SENDMSG_MAX_BUFFERS = 512
+
+# executeBatch sends statements in windows of about this many bytes
+BATCH_WINDOW_SIZE = 65536
+
+# the option execute declares unless pretty_print is asked for
+NOINDENT = 'declare option se:output "indent=no";'
+
+# how many distinct prologues and statements are kept compiled
+PROLOGUE_CACHE_SIZE = 100
+STATEMENT_CACHE_SIZE = 100
+
+# pyformat parameters in a statement, with their conversions, and variable
+# references
+PARAMETER = re.compile(r'%\((\w+)\)([-#0 +]*\d*(?:\.\d+)?[diouxXeEfFgGcrs])')
+VARIABLE = re.compile(r'\$([A-Za-z_][\w.-]*)')
+# variables a statement binds itself: for, let, some, every, at, typeswitch
+# case, declare variable and function parameters
+BOUND_VARIABLE = re.compile(
+    r'(?:\b(?:for|let|some|every|at|case|variable)\s+|[,(]\s*)'
+    r'\$([A-Za-z_][\w.-]*)(?=\s*(?:in\b|:=|at\b|as\b))')
+# the declarations that must come before variable declarations in a prolog
+PROLOG_SETTING = re.compile(
+    r'\s*(?:\(:.*?:\)\s*)*'
+    r'(?:xquery\s+version|import|declare\s+(?:'
+    r'default\s+(?:element|function)\s+namespace|namespace|boundary-space|'
+    r'default\s+collation|base-uri|construction|ordering|default\s+order|'
+    r'copy-namespaces))\b'
+    r'''(?:[^;"']|"[^"]*"|'[^']*')*;''', re.S)
+
+# loadText looks at least this far into a document for its encoding
+SNIFF_SIZE = 1024
+
+# the encoding in an XML declaration
+XML_ENCODING = re.compile(
+    r"""^(<\?xml[^>]*?encoding\s*=\s*)(["'])([A-Za-z][A-Za-z0-9._-]*)\2""")
+
+# byte order marks, longest first, and what they mean
+BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+    )
+
+# the start of an XML declaration without a byte order mark
+XML_STARTS = (
+    ('<\x00\x00\x00', 'utf-32-le'),
+    ('\x00\x00\x00<', 'utf-32-be'),
+    ('<\x00?\x00', 'utf-16-le'),
+    ('\x00<\x00?', 'utf-16-be'),
+    )
 
 # local utility functions
 
-def zString(aString):
-    """
-    return a string prefixed with null+length in network format
-    """
-    strlen = len(aString)
-    return pack('!bi%ss'% strlen,0,strlen,aString)
-
 def splitString(text,length):
     """
     Yield substrings of length or smaller
@@ -113,17 +180,121 @@ def splitString(text,length):
         split, text = text[:length], text[length:]
         yield split
 
-def normalizeMessage(message):
+def readChunks(source,size=BULKLOAD_READ_SIZE):
     """
-    un-tab and rstrip an informational message
+    Yield the data in source in chunks
 
-    tab-to-space replacement and rstripping helps with repeatable doctests
+    source may be a string, a file-like object or mmap, which is read size
+    bytes at a time, or an iterable of strings.
     """
-    message = message.decode('utf-8')
-    n = []
-    for k in message.split('\n'):
-        n.append(k.strip().replace('\t','    '))
-    return '\n'.join(n)
+    if isinstance(source,basestring):
+        yield source
+        return
+    read = getattr(source,'read',None)
+    if read is None:
+        for data in source:
+            yield data
+        return
+    data = read(size)
+    while data:
+        yield data
+        data = read(size)
+
+def sniffEncoding(head):
+    """
+    Return the encoding and the length of the byte order mark of a document
+    that starts with the str head
+
+    As in Appendix F of the XML specification, a byte order mark wins, then
+    the encoding in the XML declaration.  The default is utf-8.
+    """
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding, len(bom)
+    for start, encoding in XML_STARTS:
+        if head.startswith(start):
+            return encoding, 0
+    match = XML_ENCODING.match(head)
+    if match:
+        return match.group(3), 0
+    return 'utf-8', 0
+
+def declareUtf8(text):
+    """change the encoding in the XML declaration at the start of text"""
+    return XML_ENCODING.sub(r'\1\2utf-8\2',text,1)
+
+def utf8Chunks(chunks):
+    """
+    Yield the data in chunks as utf-8 encoded strs
+
+    utf-8 and ascii documents pass through untouched, without their byte
+    order mark.  Others are decoded incrementally, with the encoding found
+    by sniffEncoding, and the XML declaration is changed to say utf-8.
+    """
+    chunks = iter(chunks)
+    head = ''
+    for data in chunks:
+        head += data
+        if len(head) >= SNIFF_SIZE:
+            break
+    if isinstance(head,unicode):
+        if head.startswith(u'\ufeff'):
+            head = head[1:]
+        yield declareUtf8(head).encode('utf-8')
+        for data in chunks:
+            yield data.encode('utf-8')
+        return
+    encoding, bomlen = sniffEncoding(head)
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        raise DataError('Unknown encoding in XML declaration: %s' % encoding)
+    if name in ('utf-8', 'ascii'):
+        yield head[bomlen:]
+        for data in chunks:
+            yield data
+        return
+    decoder = codecs.getincrementaldecoder(name)()
+    yield declareUtf8(decoder.decode(head)).encode('utf-8')
+    for data in chunks:
+        yield decoder.decode(data).encode('utf-8')
+    yield decoder.decode('',True).encode('utf-8')
+
+def decodeItems(items):
+    """
+    decode a list of utf-8 encoded items to unicode in one pass
+
+    XML cannot contain NUL characters, so the items are joined with NULs,
+    decoded together and split again.
+    """
+    if len(items) < 2:
+        return [item.decode('utf-8') for item in items]
+    decoded = '\x00'.join(items).decode('utf-8').split(u'\x00')
+    if len(decoded) != len(items):
+        # an item had a NUL in it after all
+        return [item.decode('utf-8') for item in items]
+    return decoded
+
+def quoteValue(value):
+    """
+    Put a string in quotes
+    also double single- and double-quote characters within the string
+    """
+    if isinstance(value,basestring):
+        for quote in ('"',"'"):
+            if quote in value:
+                split = value.split(quote)
+                dq = 2*quote
+                value = dq.join(split)
+        value = "'"+ value + "'"
+    # these elifs do not seem to be necessary in py 2.4 and 2.5
+    #elif isinstance(value,long):
+        #value = str(value)
+        #while value.endswith('L'):
+            #value = value[:-1]
+    #elif isinstance(value,float):
+        #value = str(value)
+    return value
 
 def escapeAndQuote(aDict):
     """
@@ -137,25 +308,134 @@ def escapeAndQuote(aDict):
         except TypeError:
             raise ProgrammingError(
     'expected a parameters dict. Use pyformat %(var)s for constants.')
-        if isinstance(value,basestring):
-            for quote in ('"',"'"):
-                if quote in value:
-                    split = value.split(quote)
-                    dq = 2*quote
-                    value = dq.join(split)
-            value = "'"+ value + "'"
-        # these elifs do not seem to be necessary in py 2.4 and 2.5
-        #elif isinstance(value,long):
-            #value = str(value)
-            #while value.endswith('L'):
-                #value = value[:-1]
-        #elif isinstance(value,float):
-            #value = str(value)
-        newDict[item] = value
+        newDict[item] = quoteValue(value)
     return newDict
 
-def strlen(aList):
-    return sum((len(i) for i in aList))
+_prologues = {}
+
+def prologue(nsmap=None,pretty_print=False):
+    """
+    return the declarations execute puts in front of a query
+
+    The result is a utf-8 encoded str ending in a newline.  Prologues are
+    built once for each nsmap and pretty_print, and cached.
+    """
+    if nsmap:
+        key = (pretty_print, frozenset(nsmap.iteritems()))
+    else:
+        key = pretty_print
+    try:
+        return _prologues[key]
+    except KeyError:
+        pass
+    out = []
+    if nsmap:
+        for item in nsmap:
+            out.append( 'declare namespace %s="%s";' % (item, nsmap[item]))
+    if not pretty_print:
+        out.append(NOINDENT)
+    text = ''.join(['%s\n' % line for line in out])
+    if isinstance(text,unicode):
+        text = text.encode('utf-8')
+    if len(_prologues) >= PROLOGUE_CACHE_SIZE:
+        _prologues.clear()
+    _prologues[key] = text
+    return text
+
+def _quote(value):
+    """quoteValue, returning a utf-8 encoded str"""
+    if isinstance(value,unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value,str):
+        return str(value)
+    if '"' in value:
+        value = value.replace('"','""')
+    if "'" in value:
+        value = value.replace("'","''")
+    return "'" + value + "'"
+
+class Statement(object):
+    """A query template compiled for repeated execution
+
+    The template is split once at its pyformat parameters, %(name)s (or
+    another conversion, like %(name)d), and the prologue for nsmap and
+    pretty_print is built once.  bind() then only quotes the values it needs
+    (see escapeAndQuote) and joins the pieces.
+
+    A parameter that is not a %(name)s in the template, but is referred to
+    as $name, is bound as an XQuery variable: a "declare variable $name :=
+    value;" is added after the prologue.  The namespace declarations,
+    imports and settings the template starts with go in front of the
+    prologue.  Names the template binds itself, with for,
+    let, some, every or declare variable, are not.
+
+    Get Statements from SednaProtocol.prepare(), which caches them.
+    """
+    __slots__ = ('template','prologue','head','format','names',
+        'conversions','variables','returnUnicode')
+
+    def __init__(self,template,nsmap=None,pretty_print=False):
+        self.template = template
+        self.returnUnicode = isinstance(template,unicode)
+        if self.returnUnicode:
+            template = template.encode('utf-8')
+        self.prologue = prologue(nsmap,pretty_print)
+        # the declarations variable declarations go after
+        end = 0
+        while True:
+            match = PROLOG_SETTING.match(template,end)
+            if match is None or PARAMETER.search(match.group()):
+                break
+            end = match.end()
+        # they go in front of the prologue, which ends with an option
+        # declaration
+        self.head = template[:end].replace('%%','%')
+        if self.head:
+            self.head += '\n'
+
+        pieces = PARAMETER.split(template[end:])
+        self.names = tuple(pieces[1::3])
+        self.conversions = tuple(pieces[2::3])
+        # the rest of the template as a format, one plain conversion per
+        # parameter
+        format = [pieces[0]]
+        for conversion, text in zip(self.conversions,pieces[3::3]):
+            format.append('%' + conversion)
+            format.append(text)
+        self.format = ''.join(format)
+        self.variables = frozenset(VARIABLE.findall(template)
+            ).difference(self.names).difference(
+            BOUND_VARIABLE.findall(template))
+
+    def bind(self,parameters=None):
+        """return the query for parameters, a utf-8 encoded str"""
+        names = self.names
+        if not parameters:
+            if names:
+                raise ProgrammingError(
+                    'Missing parameters for %s' % ', '.join(names))
+            return self.head + self.prologue + self.format.replace('%%','%')
+        try:
+            values = []
+            for name, conversion in zip(names,self.conversions):
+                if conversion == 's':
+                    values.append(_quote(parameters[name]))
+                else:
+                    values.append(quoteValue(parameters[name]))
+            query = self.format % tuple(values)
+            if self.variables:
+                declarations = ['declare variable $%s := %s;\n' % (name,
+                    _quote(parameters[name])) for name in parameters
+                    if name in self.variables]
+                if declarations:
+                    return self.head + self.prologue + \
+                        ''.join(declarations) + query
+        except TypeError:
+            raise ProgrammingError(
+    'expected a parameters dict. Use pyformat %(var)s for constants.')
+        except KeyError as e:
+            raise ProgrammingError('Missing parameter %s' % e)
+        return self.head + self.prologue + query
 
 class BasicCursor(object):
     """a PEP-249-like cursor to a zif.sedna protocol object
@@ -167,49 +447,92 @@ class BasicCursor(object):
     quotation marks are doubled within the string.  Numbers are left unquoted.
     Only for use with atomic values.
 
+    Statements with parameters are compiled once and cached by the
+    connection; see Statement.  executemany() executes a statement for each
+    of a sequence of parameter dicts, all in one transaction.
+
+    fetchmany() and fetchall() take items from the result in batches and
+    decode each batch in one go.  fetchmany() fetches arraysize items if no
+    size is given.  Set raw to True to get the items as utf-8 encoded
+    strings, without decoding.
+
     """
     arraysize = 1
     rowcount = -1
     lastrowid = None
+    raw = False
     def __init__(self,connection):
         self.connection = connection
 
-    def execute(self,statement,parameters=None,pretty_print=False, nsmap=None):
+    def execute(self,statement,parameters=None,pretty_print=False, nsmap=None,
+            prefetch=None):
         if parameters:
-            statement = statement % escapeAndQuote(parameters)
-        self.result =  self.connection.execute(statement,
-                pretty_print=pretty_print, nsmap=nsmap)
+            conn = self.connection
+            prepared = conn.prepare(statement,nsmap,pretty_print)
+            self.result = conn.executeStatement(prepared,parameters,
+                prefetch=prefetch)
+        else:
+            self.result =  self.connection.execute(statement,
+                pretty_print=pretty_print, nsmap=nsmap, prefetch=prefetch)
         return self.result
 
-    def executemany(self,statements,parameters=None,pretty_print=False, nsmap=None):
-        for statement in statements:
-            if parameters:
-                statement = statement % escapeAndQuote(parameters)
-                self.execute(statement,pretty_print=pretty_print, nsmap=nsmap)
+    def executemany(self,statement,seq_of_parameters=None,pretty_print=False,
+            nsmap=None):
+        """
+        execute statement with each parameters dict in seq_of_parameters
+
+        All executions are in the current transaction, which is begun if
+        necessary.  The statement is compiled once, and the executions are
+        pipelined; see SednaProtocol.executeBatch, which also tells what
+        happens when one fails.
+
+        statement may also be a list of statements, each executed with
+        seq_of_parameters as the one parameters dict.
+        """
+        conn = self.connection
+        if isinstance(statement,basestring) and seq_of_parameters is None:
+            raise ProgrammingError(
+                'executemany needs a sequence of parameter dicts')
+        if not isinstance(statement,basestring):
+            if not seq_of_parameters:
+                conn.executeBatch(statement,pretty_print=pretty_print,
+                    nsmap=nsmap)
+            else:
+                conn._executeBatch((prepared.bind(seq_of_parameters),
+                    prepared.returnUnicode) for prepared in
+                    [conn.prepare(item,nsmap,pretty_print)
+                        for item in statement])
+        else:
+            prepared = conn.prepare(statement,nsmap,pretty_print)
+            conn._executeBatch((prepared.bind(parameters),
+                prepared.returnUnicode) for parameters in seq_of_parameters)
+        self.result = conn.result
 
     def __iter__(self):
         return iter(self.result)
 
     def fetchall(self):
-        return [item for item in self.result]
+        return self._fetch(None)
 
     def fetchone(self):
-        try:
-            return self.result.next()
-        except StopIteration:
-            return None
+        items = self._fetch(1)
+        if items:
+            return items[0]
+        return None
 
     def fetchmany(self,size=None):
         if size is None:
             size = self.arraysize
-        else:
-            theList = []
-            for counter in xrange(size):
-                try:
-                    theList.append(self.fetchone())
-                except StopIteration:
-                    break
-            return theList
+        return self._fetch(size)
+
+    def _fetch(self,size):
+        result = self.result
+        if not isinstance(result,Result):
+            raise ProgrammingError('No result set to fetch from.')
+        items = result.fetch(size)
+        if self.raw or not result.returnUnicode:
+            return items
+        return decodeItems(items)
 
     def setinputsizes(self,sizes):
         pass
@@ -266,27 +589,171 @@ class Result(object):
             else:
                 return currItem
 
+    def fetch(self,size=None):
+        """
+        return a list of the next size items, or of all the remaining items
+        if size is None, as utf-8 encoded strings
+        """
+        items = []
+        append = items.append
+        send = self.conn._send_string
+        while size is None or len(items) < size:
+            item = self.item
+            if item == '_DUMMY_':
+                raise DatabaseError('Item not sent')
+            if item is None:
+                break
+            append(item)
+            if self.more:
+                send(token=SEDNA_GET_NEXT_ITEM)
+            else:
+                # that was the last one
+                self.item = None
+        return items
+
     def _get_value(self):
-        return ''.join(list(self))
+        value = ''.join(self.fetch())
+        if value and self.returnUnicode:
+            return value.decode('utf-8')
+        return value
 
     value = property(_get_value)
 
+    # called by the protocol handlers
+
+    def _receiveItem(self,item):
+        self.item = item
 
-class ErrorInfo(object):
-    def __init__(self,msg):
-        #first Int is the code.
-        self.code, = unpack('!I',msg[:4])
-        # two Ints and a byte = 9
-        # normalize the info so it works reliably in doctests.
-        # ahh.  the world makes sense again... :)
-        # self.sednaCode = msg[msg.find(':')+8:msg.find('\n')]
-        self.info = "[%s] %s" % (self.code, normalizeMessage(msg[9:].strip()))
+    def _receiveEnd(self,item):
+        self.more = False
+        self.item = item
 
 
-class DebugInfo(ErrorInfo):
-    def __init__(self,msg):
-        self.code = None
-        self.info = "%s" % normalizeMessage(msg[9:].strip())
+class PrefetchResult(Result):
+    """A Result that keeps several SEDNA_GET_NEXT_ITEM requests in flight.
+
+    Up to 'depth' requests are sent ahead of the items actually consumed, so
+    the server produces the next items while the current ones are processed.
+    Received items wait in a buffer; no more requests are sent while the
+    buffer holds 'maxBytes' or more, so memory use stays bounded.
+
+    Nothing else may be sent on the connection while requests are in
+    flight.  The protocol discards the outstanding replies if another
+    request is sent before the result is exhausted.
+
+    """
+
+    def __init__(self,conn,returnUnicode,depth,maxBytes=PREFETCH_BUFFER_SIZE):
+        Result.__init__(self,conn,returnUnicode)
+        self.depth = depth
+        self.maxBytes = maxBytes
+        self.items = deque()
+        self.bufferedBytes = 0
+
+    def getTime(self):
+        # replies in flight come before the time, so collect them first.
+        self._receive(force=True)
+        return Result.getTime(self)
+
+    time = property(getTime)
+
+    def next(self):
+        items = self.items
+        while not items and self.more:
+            self._request()
+            self._receive()
+        if not items:
+            raise StopIteration
+        item = items.popleft()
+        self.bufferedBytes -= len(item)
+        # keep the server busy while the caller works on this item
+        self._request()
+        if self.returnUnicode:
+            return item.decode('utf-8')
+        return item
+
+    def fetch(self,size=None):
+        items = self.items
+        batch = []
+        while size is None or len(batch) < size:
+            while not items and self.more:
+                self._request()
+                self._receive()
+            if not items:
+                break
+            if size is None:
+                count = len(items)
+            else:
+                count = min(len(items),size - len(batch))
+            for k in range(count):
+                item = items.popleft()
+                self.bufferedBytes -= len(item)
+                batch.append(item)
+            self._request()
+        return batch
+
+    def _request(self):
+        conn = self.conn
+        while self.more and conn._inflight < self.depth \
+                and self.bufferedBytes < self.maxBytes:
+            conn._send_string(token=SEDNA_GET_NEXT_ITEM,respond=False)
+            conn._inflight += 1
+
+    def _receive(self,force=False):
+        conn = self.conn
+        while self.more and conn._inflight and (force or not self.items
+                or self.bufferedBytes < self.maxBytes):
+            conn._inflight -= 1
+            conn._get_response()
+        if not self.more and conn._inflight:
+            # requests sent after the last item are not interesting.
+            conn._drainInflight()
+
+    def _receiveItem(self,item):
+        self.items.append(item)
+        self.bufferedBytes += len(item)
+
+    def _receiveEnd(self,item):
+        self.more = False
+        if item is not None:
+            self._receiveItem(item)
+
+
+class CachedResult(Result):
+    """A Result served from a ResultCache, without asking the server.
+
+    The server did not evaluate the query, so result.time is None.
+
+    """
+
+    def __init__(self,items,returnUnicode):
+        self.conn = None
+        self._time = None
+        self.more = False
+        self.items = deque(items)
+        self.returnUnicode = returnUnicode
+
+    def getTime(self):
+        return self._time
+
+    time = property(getTime)
+
+    def next(self):
+        if not self.items:
+            raise StopIteration
+        item = self.items.popleft()
+        if self.returnUnicode:
+            return item.decode('utf-8')
+        return item
+
+    def fetch(self,size=None):
+        items = self.items
+        if size is None or size >= len(items):
+            batch = list(items)
+            items.clear()
+            return batch
+        popleft = items.popleft
+        return [popleft() for k in range(size)]
 
 
 class SednaError(object):
@@ -319,9 +786,28 @@ class SednaProtocol(object):
 
     successful updates return True
 
+    Set prefetch to a positive number to have query results request that
+    many items ahead of the caller, bounded by prefetchBytes of buffered
+    data.  See PrefetchResult.
+
+    executeBatch() pipelines many statements: they are sent without
+    waiting for each one's reply.  See executeBatch.
+
+    Set resultCache to a zif.sedna.cache.ResultCache to serve repeated
+    queries from the client.  Several connections may share one.
+
+    queryCount is the number of queries and statements executed so far, and
+    transactionCount the number of transactions begun.
+    bytesSent, bytesReceived, framesSent and framesReceived count the
+    traffic on the connection.
+
+    Set profiler to a callable to have it called with a
+    zif.sedna.querystats.QueryStats for every query.  Set profileServerTime
+    to also get the server's processing time, for an extra round trip.
+
     """
-    headerFormat = '!II'
-    prefixLength = calcsize(headerFormat)
+    headerFormat = HEADER.format
+    prefixLength = HEADER_SIZE
     maxDataLength = SEDNA_MAX_BODY_LENGTH - prefixLength
     result = None
     error = None
@@ -334,6 +820,34 @@ class SednaProtocol(object):
     ermsgs = None
     cursorFactory = BasicCursor
     returnUnicode = True
+    prefetch = 0
+    prefetchBytes = PREFETCH_BUFFER_SIZE
+    batchWindow = BATCH_WINDOW_SIZE
+    _prefetch = 0
+    _inflight = 0
+    _receiveBuffer = None
+    _messages = None
+    _progress = None
+    _statements = None
+    queryCount = 0
+    transactionCount = 0
+    bytesSent = 0
+    bytesReceived = 0
+    framesSent = 0
+    framesReceived = 0
+    profiler = None
+    profileServerTime = False
+    # True while the replies to a batch are read
+    _batching = False
+    _stats = None
+    tracePrefix = None
+    _traceRate = None
+    _capture = None
+    resultCache = None
+    _updated = False
+    _recording = None
+    _recordKey = None
+    _recordBytes = 0
 
     # error exposition (PEP-249)
     Error = Error
@@ -351,7 +865,8 @@ class SednaProtocol(object):
 
     # queries
 
-    def execute(self, query, format=0, pretty_print=False, nsmap=None):
+    def execute(self, query, format=0, pretty_print=False, nsmap=None,
+            prefetch=None):
         """
         Send query to the Sedna server.
 
@@ -360,39 +875,316 @@ class SednaProtocol(object):
                   1 for SXML
 
         nsmap is a dict with namespace mapping.
+
+        prefetch is the number of items to request ahead of the caller.
+        The default, None, uses self.prefetch.  0 fetches one item at a time.
         """
-        # first, clear out previous stuff in case we are in a LRP
-        self.ermsgs = []
-        self.currItem = []
-        self.result = None
-        self._resetBuffer()
         if isinstance(query,unicode):
             query = query.encode('utf-8')
-            self.returnUnicode = True
+            returnUnicode = True
         else:
-            self.returnUnicode = False
+            returnUnicode = False
         #else:
         #    raise ProgrammingError("Expected unicode, got %s." % type(query))
-        out = []
+        if self.resultCache is not None:
+            query = normalizeQuery(query)
+        return self._execute(prologue(nsmap,pretty_print) + query,
+            returnUnicode,format,prefetch)
+
+    query = execute
+
+    def prepare(self, template, nsmap=None, pretty_print=False):
+        """
+        return a Statement for template, compiled once and cached.
+
+        The cache holds up to STATEMENT_CACHE_SIZE statements, and is
+        cleared when it is full.
+        """
         if nsmap:
-            for item in nsmap:
-                out.append( 'declare namespace %s="%s";' % (item, nsmap[item]))
-        if not pretty_print:
-            noindent = 'declare option se:output "indent=no";'
-            out.append(noindent)
-            #query = '%s\n%s' % (noindent,query)
-        out.append(query)
-        query = '\n'.join(out)
+            key = (template, pretty_print, frozenset(nsmap.iteritems()))
+        else:
+            key = (template, pretty_print)
+        statements = self._statements
+        if statements is None:
+            statements = self._statements = {}
+        try:
+            return statements[key]
+        except KeyError:
+            pass
+        statement = Statement(template,nsmap,pretty_print)
+        if len(statements) >= STATEMENT_CACHE_SIZE:
+            statements.clear()
+        statements[key] = statement
+        return statement
+
+    def executeStatement(self, statement, parameters=None, format=0,
+            prefetch=None):
+        """
+        execute a Statement from prepare() with a dict of parameters
+        """
+        return self._execute(statement.bind(parameters),
+            statement.returnUnicode,format,prefetch)
+
+    def executeBatch(self, statements, format=0, pretty_print=False,
+            nsmap=None):
+        """
+        execute statements, a sequence of update statements, pipelined
+
+        The statements are executed in order, in the current transaction,
+        which is begun if necessary.  They are sent back-to-back, without
+        waiting for the server to acknowledge each one, and the replies are
+        read as they come.  A batch of small statements takes about one
+        round trip per batchWindow bytes, instead of one per statement.
+
+        If a statement fails, the replies to the statements already sent are
+        read, the transaction is rolled back, and the error is raised with
+        "statement <n>: " in front of the message.  The exception has the
+        index of the failing statement in statements as its index attribute,
+        and the statement, as sent, as its statement attribute.  The rest of
+        the statements are not sent.
+
+        Queries may be part of a batch, but only the result of the last
+        statement is kept, as self.result.  With a profiler, the batch gets
+        one QueryStats, finished (and the server time asked for) once every
+        reply is read.
+
+        return the number of statements executed.
+        """
+        pro = prologue(nsmap,pretty_print)
+        def queries():
+            for statement in statements:
+                if isinstance(statement,unicode):
+                    yield pro + statement.encode('utf-8'), True
+                else:
+                    yield pro + statement, False
+        return self._executeBatch(queries(),format)
+
+    def _executeBatch(self, queries, format=0):
+        """
+        send queries, (utf-8 encoded str, returnUnicode) pairs, pipelined
+
+        Each window of statements is sent before the replies to the window
+        before it are read, so the server has the next window to work on
+        while we read.
+        """
+        if self._stats is not None:
+            self._finishProfile(False)
+        self.ermsgs = []
+        self.currItem = []
+        self.result = None
+        self._resetBuffer()
+        if self._inflight:
+            self._drainInflight()
+        self._prefetch = 0
         if not self.inTransaction:
             self.begin()
         self.error = None
+        self._recording = None
+        if self._traceRate is not None:
+            self.doTrace = random.random() < self._traceRate
+        stats = None
+        if self.profiler is not None:
+            # one QueryStats for the batch, named by its first statement
+            stats = self._stats = QueryStats('',self)
+        checkUpdates = self.resultCache is not None
+        # (index, query) of the statements sent and not yet acknowledged
+        unacknowledged = deque()
+        # the number of statements in each window sent
+        windows = deque()
+        buffers = []
+        frames = size = queued = 0
+        count = 0
+        failure = None
+        queries = iter(queries)
+        # replies finish no QueryStats until the last one is read
+        self._batching = True
+        try:
+            while True:
+                try:
+                    query, returnUnicode = next(queries)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    # a statement could not be made.  Forget the ones not
+                    # sent, and read the replies to the others.
+                    for k in range(queued):
+                        unacknowledged.pop()
+                    self._batchReplies(unacknowledged,len(unacknowledged),
+                        None)
+                    raise e
+                if checkUpdates and not self._updated and \
+                        not isCacheable(query):
+                    self._updated = True
+                if stats is not None and not stats.query:
+                    stats.query = query
+                self.returnUnicode = returnUnicode
+                messages = executeBuffers(query,format)
+                buffers.extend(messages)
+                frames += (len(messages) + 1) // 2
+                size += len(query)
+                unacknowledged.append((count,query))
+                count += 1
+                queued += 1
+                if self.doTrace:
+                    self._traceRequest(SEDNA_EXECUTE,query)
+                if size >= self.batchWindow:
+                    self._sendBatch(buffers,frames)
+                    windows.append(queued)
+                    buffers = []
+                    frames = size = queued = 0
+                    if len(windows) > 1:
+                        failure = self._batchReplies(unacknowledged,
+                            windows.popleft(),failure)
+                        if failure is not None:
+                            break
+            if buffers and failure is None:
+                self._sendBatch(buffers,frames)
+            self.queryCount += count
+            failure = self._batchReplies(unacknowledged,len(unacknowledged),
+                failure)
+        finally:
+            self._batching = False
+        if stats is not None and self._stats is stats:
+            if failure is None:
+                self._finishProfile()
+            else:
+                self._finishProfile(error=str(failure[2]))
+        if failure is not None:
+            index, query, error = failure
+            if self.inTransaction:
+                self.rollback()
+            exception = error.__class__('statement %d: %s' % (index, error))
+            exception.index = index
+            exception.statement = query
+            raise exception
+        return count
+
+    def _sendBatch(self,buffers,frames):
+        self._sendBuffers(buffers)
+        self.framesSent += frames
+
+    def _batchReplies(self,unacknowledged,n,failure):
+        """
+        read the replies to the first n unacknowledged statements
+
+        return failure, or (index, query, error) of the first statement that
+        failed.
+        """
+        for k in range(n):
+            index, query = unacknowledged.popleft()
+            self.ermsgs = []
+            self.currItem = []
+            try:
+                self._get_response()
+            except DatabaseError as e:
+                if failure is None:
+                    failure = (index, query, e)
+        return failure
+
+    def _execute(self, query, returnUnicode, format=0, prefetch=None):
+        """send query, a complete utf-8 encoded str"""
+        if self._stats is not None:
+            # the previous result was not read to the end
+            self._finishProfile(False)
+        # first, clear out previous stuff in case we are in a LRP
+        self.ermsgs = []
+        self.currItem = []
+        self.result = None
+        self._resetBuffer()
+        if prefetch is None:
+            prefetch = self.prefetch
+        self._prefetch = prefetch
+        self.returnUnicode = returnUnicode
+        if not self.inTransaction:
+            self.begin()
+        self.error = None
+        self.queryCount += 1
+        self._recording = None
+        if self._traceRate is not None:
+            self.doTrace = random.random() < self._traceRate
+        if self.profiler is not None:
+            return self._executeProfiled(query,returnUnicode,format)
+        if self.resultCache is not None and self._cached(query,returnUnicode,
+                format):
+            return self.result
         self._send_string(query,token=SEDNA_EXECUTE,format=format)
         return self.result
 
-    query = execute
+    def _executeProfiled(self,query,returnUnicode,format):
+        """_execute, collecting QueryStats for self.profiler"""
+        stats = self._stats = QueryStats(query,self)
+        try:
+            if self.resultCache is not None and self._cached(query,
+                    returnUnicode,format):
+                stats.cached = True
+                stats.items = len(self.result.items)
+            else:
+                self._send_string(query,token=SEDNA_EXECUTE,format=format)
+        except Error as e:
+            if self._stats is stats:
+                self._finishProfile(error=str(e))
+            raise
+        if self._stats is stats:
+            stats.firstItem = time.time() - stats.started
+            if stats.cached or not isinstance(self.result,Result):
+                # an update, or nothing more to come
+                self._finishProfile()
+        return self.result
+
+    def _finishProfile(self,complete=True,error=None):
+        """complete self._stats and hand it to the profiler"""
+        stats = self._stats
+        self._stats = None
+        stats.finish(self,complete,error)
+        if self.profileServerTime and complete and error is None and \
+                not stats.cached:
+            if self._inflight:
+                self._drainInflight()
+            stats.serverTime = self._send_string(token=SEDNA_SHOW_TIME)
+            if isinstance(self.result,Result):
+                self.result._time = stats.serverTime
+        profiler = self.profiler
+        if profiler is not None:
+            try:
+                profiler(stats)
+            except Exception:
+                logging.getLogger().exception('query profiler failed')
+
+    def _cached(self,query,returnUnicode,format):
+        """
+        serve query from the result cache, or get ready to record its result
+
+        return True if self.result was set from the cache
+        """
+        if not isCacheable(query):
+            # the cache is stale once this commits
+            self._updated = True
+            return False
+        if self._updated:
+            # read our own changes from the server
+            return False
+        key = (query,returnUnicode,format)
+        items = self.resultCache.get(key)
+        if items is not None:
+            self.result = CachedResult(items,returnUnicode)
+            return True
+        self._recording = []
+        self._recordKey = key
+        self._recordBytes = 0
+        return False
+
+    def _record(self,item):
+        """keep item for the result cache, unless the result gets too big"""
+        self._recordBytes += len(item)
+        if self._recordBytes > self.resultCache.maxResultBytes:
+            self._recording = None
+        else:
+            self._recording.append(item)
 
     def close(self):
         """close the connection"""
+        if self._stats is not None:
+            self._finishProfile(False)
         if self.socket and not self.closed:
             self._send_string(token=SEDNA_CLOSE_CONNECTION)
             self.closed = True
@@ -425,6 +1217,8 @@ class SednaProtocol(object):
         """
         commit transaction
         """
+        if self._stats is not None:
+            self._finishProfile(False)
         self._resetBuffer()
         res = self._send_string(token=SEDNA_COMMIT_TRANSACTION)
         return res
@@ -433,6 +1227,8 @@ class SednaProtocol(object):
         """
         rollback transaction
         """
+        if self._stats is not None:
+            self._finishProfile(False)
         self._resetBuffer()
         res = self._send_string(token=SEDNA_ROLLBACK_TRANSACTION)
         return res
@@ -454,38 +1250,59 @@ class SednaProtocol(object):
         else:
             return 'none'
 
+    def ping(self):
+        """
+        make a cheap round trip to the server, to see that the connection
+        still works.  Raises an error if it does not.
+
+        This asks for the last query time, which changes nothing in the
+        session.
+        """
+        self._resetBuffer()
+        self._send_string(token=SEDNA_SHOW_TIME)
+        return True
+
 # Miscellaneous public methods
 
     # sometimes, you just want to upload a document...
 
-    def loadText(self,text,document_name,collection_name=None):
+    def loadText(self,text,document_name,collection_name=None,
+            progress=None):
         """
-        load a string or stringio into the database as document_name
+        load a string into the database as document_name
+
+        text may also be a file-like object or mmap, or an iterable of
+        strings.  These are streamed to the server as they are read.
 
         if collection_name is provided, document will go in that
         collection.
 
-        Just in case there is an <?xml preamble with an encoding, we run it
-        through an elementtree parser and presumably get unicode back.
+        Sedna wants utf-8.  Unicode is encoded.  A str or file in utf-8 or
+        ascii is sent as-is.  Anything else needs a byte order mark or an
+        <?xml preamble with its encoding; it is transcoded to utf-8 as it is
+        sent.  See utf8Chunks.
 
-        If it's already unicode, no big deal...
+        progress, if provided, is called as progress(sent, rate) while the
+        document is sent, with the number of bytes sent so far and the rate
+        in bytes per second.
 
         """
-        if not isinstance(text,unicode):
-            text = ET.tostring(ET.XML(text), encoding=unicode)
-        self._inputBuffer = StringIO(text)
+        self._inputBuffer = text
         s = 'LOAD STDIN "%s"' % document_name
         if collection_name:
             s += ' "%s"' % collection_name
+        self._progress = progress
         try:
             res = self.execute(s,pretty_print=True)
         finally:
             #always clear input buffer
             self._inputBuffer = ''
+            self._progress = None
         return res
 
 
-    def loadFile(self,filename,document_name,collection_name=None):
+    def loadFile(self,filename,document_name,collection_name=None,
+            progress=None):
         """
         load a file by name into the database as document_name
 
@@ -494,11 +1311,17 @@ class SednaProtocol(object):
 
         if collection_name is provided, document will go in that
         collection.
+
+        progress is as for loadText.
         """
         s = 'LOAD "%s" "%s"' % (filename, document_name)
         if collection_name:
             s += ' "%s"' % collection_name
-        return self.execute(s,pretty_print=True)
+        self._progress = progress
+        try:
+            return self.execute(s,pretty_print=True)
+        finally:
+            self._progress = None
 
     def loadModule(self,filename):
         s = 'LOAD OR REPLACE MODULE "%s"' % (filename)
@@ -576,9 +1399,7 @@ class SednaProtocol(object):
             val = READONLY_TRANSACTION
         else:
             val = UPDATE_TRANSACTION
-        token = SEDNA_SET_SESSION_OPTIONS
-        data = pack("!I",val)+zString('')
-        self._send_string(data,token)
+        self._setSessionOption(val)
 
 # debug helpers
 
@@ -588,9 +1409,7 @@ class SednaProtocol(object):
 
         Set this within a transaction.
         """
-        token = SEDNA_SET_SESSION_OPTIONS
-        data = pack("!I",DEBUG_ON)+zString('')
-        self._send_string(data,token)
+        self._setSessionOption(DEBUG_ON)
 
     def setDebugHandler(self,fn):
         self.handleDebug = fn
@@ -616,16 +1435,50 @@ class SednaProtocol(object):
 
         Also sent within a transaction.
         """
-        token = SEDNA_SET_SESSION_OPTIONS
-        data = pack("!I",DEBUG_OFF)+zString('')
+        self._setSessionOption(DEBUG_OFF)
 
-        self._send_string(data,token)
+    def traceOn(self,rate=1.0,prefix=None):
+        """
+        log the messages to and from the server, at logging.INFO level.
 
-    def traceOn(self):
-        self.doTrace = True
+        rate is the fraction of queries traced, chosen at random; the
+        messages that follow a query, up to the next query, go with it.
+
+        prefix is the most bytes of each message's data logged.  Messages
+        are shown in full and normalized by default; this is expensive for
+        big results.
+        """
+        self.tracePrefix = prefix
+        if rate < 1.0:
+            self._traceRate = rate
+            self.doTrace = random.random() < rate
+        else:
+            self._traceRate = None
+            self.doTrace = True
 
     def traceOff(self):
         self.doTrace = False
+        self._traceRate = None
+
+    def captureOn(self,filename,maxBytes=64*1048576,backupCount=5):
+        """
+        write the raw messages to and from the server to filename.
+
+        The file is rotated when it grows past maxBytes, keeping backupCount
+        old files.  See zif.sedna.capture for reading them.  filename may
+        also be a zif.sedna.capture.FrameCapture, to share one file among
+        connections.
+        """
+        if isinstance(filename,FrameCapture):
+            self._capture = filename
+        else:
+            self._capture = FrameCapture(filename,maxBytes,backupCount)
+
+    def captureOff(self):
+        """stop capturing; returns the FrameCapture, which is left open"""
+        capture = self._capture
+        self._capture = None
+        return capture
 
     def resetSessionOptions(self):
         """
@@ -642,6 +1495,7 @@ class SednaProtocol(object):
         self.password = passwd
         self.database = db
         self.ermsgs = []
+        self._messages = MessageBuffer()
         self._resetBuffer()
         self._openSocket(host,port)
 
@@ -665,11 +1519,11 @@ class SednaProtocol(object):
     def _openSocket(self,host,port):
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        except socket.error(e):
+        except socket.error as e:
             raise InterfaceError("Could not create socket: %s" % e)
         try:
             self.socket.connect((host,port))
-        except socket.error(e):
+        except socket.error as e:
             if self.socket:
                 self.socket.close()
             raise InterfaceError(
@@ -706,6 +1560,8 @@ class SednaProtocol(object):
         # utf-8 encoded string
         if not isinstance(data,str):
             raise InterfaceError ("Expected string, got %s." % data)
+        if self._inflight and token != SEDNA_GET_NEXT_ITEM:
+            self._drainInflight()
         if token in (SEDNA_EXECUTE, SEDNA_EXECUTE_LONG):
             self.result = None
             datalen = len(data)
@@ -720,56 +1576,145 @@ class SednaProtocol(object):
                 self._send_string(token=SEDNA_LONG_QUERY_END)
                 # return here to prevent endless recursion...
                 return
-            # if we are doing EXECUTE or EXECUTE_LONG, we need to prefix the
-            # request with the byte indicating the desired output format
-            data = pack('!b',format) + zString(data)
+            # if we are doing EXECUTE or EXECUTE_LONG, the request is
+            # prefixed with the byte indicating the desired output format
+            message = self._messages.executeMessage(data,format,int(token))
         elif len(data)+self.prefixLength > self.maxDataLength:
             raise InterfaceError("Message is too long.")
-        self._sendSocketData(pack(self.headerFormat,int(token),len(data)
-            ) + data)
+        else:
+            message = self._messages.message(int(token),data)
+        self._sendSocketData(message)
+        self.framesSent += 1
 
         if self.doTrace:
-            logger = logging.getLogger()
-            if token in (SEDNA_EXECUTE, SEDNA_EXECUTE_LONG):
-                trace = data[6:]
-            elif token == SEDNA_SET_SESSION_OPTIONS:
-                trace = ''
-            else:
-                trace = data[5:]
-            if trace:
-                logger.info("(C) %s %s" % (codes[token],
-                    trace.strip()))
-            else:
-                logger.info("(C) %s" % codes[token])
+            self._traceRequest(token,data)
+
+        if respond:
+            return self._get_response()
 
+    def _sendMessage(self,message,token,respond=True):
+        """
+        send a complete, already-encoded message to the server
+
+        message may be a memoryview from self._messages
+        """
+        if self._inflight:
+            self._drainInflight()
+        self._sendSocketData(message)
+        self.framesSent += 1
+        if self.doTrace:
+            data = message[HEADER_SIZE:]
+            if isinstance(data,memoryview):
+                data = data.tobytes()
+            self._traceRequest(token,data)
         if respond:
             return self._get_response()
 
+    def _setSessionOption(self,option):
+        self._sendMessage(sessionOptionMessage(option),
+            SEDNA_SET_SESSION_OPTIONS)
+
+    def _traceRequest(self,token,data):
+        logger = logging.getLogger()
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        if token in (SEDNA_EXECUTE, SEDNA_EXECUTE_LONG):
+            trace = data
+        elif token == SEDNA_SET_SESSION_OPTIONS:
+            trace = ''
+        else:
+            trace = data[DATA_OFFSET:]
+        prefix = self.tracePrefix
+        if prefix is not None and len(trace) > prefix:
+            logger.info("(C) %s %s... [%s bytes]",codes[token],
+                trace[:prefix].decode('utf-8','replace'),len(trace))
+        elif trace:
+            logger.info("(C) %s %s" % (codes[token],
+                trace.strip()))
+        else:
+            logger.info("(C) %s" % codes[token])
+
     def _get_response(self):
         """get the response
 
-        first, get enough of the response to determine its length,
-        then obtain the remainder of the response based on the length.
+        A response may take several messages: an item arrives as any number
+        of SEDNA_ITEM_PART messages, and SEDNA_QUERY_SUCCEEDED and
+        SEDNA_DEBUG_INFO are followed by more of the response.  We loop over
+        the messages until a handler completes the response, and return what
+        that handler returns.
 
-        dispatch response to appropriate handler
+        For each message, first get enough of the response to determine its
+        length, then obtain the remainder based on the length, then dispatch
+        to the appropriate handler.
         """
+        handlers = self.handlers
+        partial = self.partialResponses
+        while True:
+            token, length = self._readHeader()
+            if token == SEDNA_ITEM_PART and not self.doTrace and \
+                    self._capture is None:
+                # the bulk of a large result. Skip the Int + byte in front
+                # of the data and collect it without further ado.
+                self._fillBuffer(length)
+                self._bufferStart += DATA_OFFSET
+                self.currItem.append(self._getSocketData(length-DATA_OFFSET))
+                continue
+            msg = self._getSocketData(length)
+            if self._capture is not None:
+                self._captureResponse(token,msg)
+            # handlers are call-backs after the data are received
+            if self.doTrace:
+                self._traceResponse(token,msg)
+            value = handlers[token](self, msg)
+            if token not in partial:
+                return value
+
+    def _traceResponse(self,token,msg):
+        logger = logging.getLogger()
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        z = payload(token,msg)
+        prefix = self.tracePrefix
+        if prefix is not None and len(z) > prefix:
+            # only the prefix is decoded
+            logger.info("(S) %s %s... [%s bytes]",codes[token],
+                z[:prefix].decode('utf-8','replace'),len(z))
+        elif z:
+            logger.info("(S) %s %s" % (codes[token], normalizeMessage(z)))
+        else:
+            logger.info("(S) %s" % codes[token])
+
+    def _readHeader(self):
+        """read a message header from the server. return (token, length)"""
         prefixLen = self.prefixLength
-        #get the header, two ints
-        header = self._getSocketData(prefixLen)
-        token,length = unpack(self.headerFormat,header)
+        #get the header, two ints, straight out of the receive buffer
+        self._fillBuffer(prefixLen)
+        header = HEADER.unpack_from(self._receiveBuffer,self._bufferStart)
+        self._bufferStart += prefixLen
+        self.framesReceived += 1
+        return header
+
+    def _readMessage(self):
+        """read one message from the server. return (token, body)"""
+        token, length = self._readHeader()
         msg = self._getSocketData(length)
-        # handlers are call-backs after the data are received
-        if self.doTrace:
-            logger = logging.getLogger()
-            if token in (SEDNA_ERROR_RESPONSE, SEDNA_DEBUG_INFO):
-                z = msg[9:]
-            else:
-                z = msg[5:]
-            if z:
-                logger.info("(S) %s %s" % (codes[token], normalizeMessage(z)))
-            else:
-                logger.info("(S) %s" % codes[token])
-        return self.handlers[token](self, msg)
+        if self._capture is not None:
+            self._captureResponse(token,msg)
+        return token, msg
+
+    def _captureResponse(self,token,msg):
+        self._capture.writeBuffers(SERVER,(HEADER.pack(token,len(msg)),msg))
+
+    def _drainInflight(self):
+        """
+        discard the replies to SEDNA_GET_NEXT_ITEM requests still in flight
+        """
+        while self._inflight:
+            self._inflight -= 1
+            token = None
+            while token not in (SEDNA_ITEM_END, SEDNA_RESULT_END,
+                    SEDNA_ERROR_RESPONSE):
+                token, msg = self._readMessage()
 
     def _getInTransaction(self):
         return self._inTransaction
@@ -786,6 +1731,7 @@ class SednaProtocol(object):
             self._inTransaction = bool
         else:
             self._inTransaction = bool
+            self._updated = False
             # release lock.  Transaction is complete.
             self.lock.release()
 
@@ -802,51 +1748,127 @@ class SednaProtocol(object):
         while totalsent < datalen:
             try:
                 sent = self.socket.send(data[totalsent:])
-            except socket.error(e):
+            except socket.error as e:
                 raise InterfaceError('Error writing to socket: %s' % e)
             if sent == 0:
                 raise InterfaceError("Socket connection broken.")
             totalsent += sent
+        self.bytesSent += datalen
+        if self._capture is not None:
+            self._capture.write(CLIENT,data)
+
+    def _sendBuffers(self,buffers):
+        """
+        send a list of strings and memoryviews to the socket
+
+        where the socket has sendmsg, this is a gathering write, and the
+        buffers are not joined first.
+        """
+        sendmsg = getattr(self.socket,'sendmsg',None)
+        if sendmsg is None:
+            data = bytearray()
+            for buf in buffers:
+                data += buf
+            self._sendSocketData(data)
+            return
+        if self._capture is not None:
+            self._capture.writeBuffers(CLIENT,buffers)
+        first = 0
+        count = len(buffers)
+        while first < count:
+            try:
+                sent = sendmsg(buffers[first:first + SENDMSG_MAX_BUFFERS])
+            except socket.error as e:
+                raise InterfaceError('Error writing to socket: %s' % e)
+            if sent == 0:
+                raise InterfaceError("Socket connection broken.")
+            self.bytesSent += sent
+            # skip what was sent, keeping the rest of a partly-sent buffer
+            while sent:
+                buflen = len(buffers[first])
+                if sent < buflen:
+                    buffers[first] = memoryview(buffers[first])[sent:]
+                    break
+                sent -= buflen
+                first += 1
 
     def _getSocketData(self,length):
         """
         get 'length' bytes from the socket
+
+        the bytes are copied out of the receive buffer exactly once.
+        """
+        self._fillBuffer(length)
+        start = self._bufferStart
+        end = start + length
+        data = self._bufferView[start:end].tobytes()
+        if end == self._bufferEnd:
+            # everything has been consumed; start over at the front
+            self._bufferStart = self._bufferEnd = 0
+        else:
+            self._bufferStart = end
+        return data
+
+    def _fillBuffer(self,length):
+        """
+        assure that at least 'length' unread bytes are in the receive buffer
+
+        the socket is read with recv_into in chunks as large as the free
+        space in the buffer, so a single call typically receives several
+        server messages.
         """
-        bufferLen = strlen(self.receiveBuffer)
-        while bufferLen < length:
-            if bufferLen == 0:
+        start = self._bufferStart
+        available = self._bufferEnd - start
+        if available >= length:
+            return
+        size = len(self._receiveBuffer)
+        if start + length > size:
+            # not enough room after the unread data. Move it to the front,
+            # in a larger buffer if the message will not fit otherwise.
+            unread = self._bufferView[start:self._bufferEnd].tobytes()
+            if length > size:
+                self._receiveBuffer = bytearray(max(length,2*size))
+                self._bufferView = memoryview(self._receiveBuffer)
+            self._receiveBuffer[:available] = unread
+            self._bufferStart = 0
+            self._bufferEnd = available
+        while available < length:
+            if available == 0:
                 # We don't have anything yet.
                 # Yield this processing time-slice to other threads.
                 time.sleep(0)
             try:
-                data = self.socket.recv(length-bufferLen)
-            except socket.error(e):
+                received = self.socket.recv_into(
+                    self._bufferView[self._bufferEnd:])
+            except socket.error as e:
                 raise InterfaceError('Error reading from socket: %s' % e)
-            self.receiveBuffer.append(data)
-            bufferLen += len(data)
-        all = ''.join(self.receiveBuffer)
-        data, self.receiveBuffer = all[:length], [all[length:]]
-        return data
+            if received == 0:
+                raise InterfaceError("Socket connection broken.")
+            self.bytesReceived += received
+            self._bufferEnd += received
+            available += received
 
     def _resetBuffer(self):
-        self.receiveBuffer = []
+        if self._inflight:
+            self._drainInflight()
+        if self._receiveBuffer is None:
+            self._receiveBuffer = bytearray(RECEIVE_BUFFER_SIZE)
+            self._bufferView = memoryview(self._receiveBuffer)
+        self._bufferStart = self._bufferEnd = 0
 
 # handlers
 
 # start-up
 
     def _sendSessionParameters(self,msg):
-        token = SEDNA_SESSION_PARAMETERS
-        msg = pack('!bb',SEDNA_VERSION_MAJOR,SEDNA_VERSION_MINOR) \
-            + zString(self.username.encode('utf-8')) \
-            + zString(self.database.encode('utf-8'))
-        self._send_string(msg, token)
+        self._sendMessage(sessionParametersMessage(self.username,
+            self.database),SEDNA_SESSION_PARAMETERS)
 
 # authentication
 
     def _sendAuthParameters(self,msg):
         token = SEDNA_AUTHENTICATION_PARAMETERS
-        msg = zString(self.password.encode('utf-8'))
+        msg = zString(self.password)
         self._send_string(msg,token)
 
     def _authenticationOK(self,msg):
@@ -865,11 +1887,14 @@ class SednaProtocol(object):
             self.inTransaction = False
         self.ermsgs.append(error.info)
         error.info = '\n'.join(self.ermsgs)
+        if self._stats is not None and not self._batching:
+            self._finishProfile(error=error.info)
         raise SednaError(error)
 
 # transactions - receivers
 
     def _beginTransactionOK(self,msg):
+        self.transactionCount += 1
         self.inTransaction = True
 
     def _beginTransactionFailed(self,msg):
@@ -879,6 +1904,8 @@ class SednaProtocol(object):
         raise SednaError(error)
 
     def _commitTransactionOK(self,msg):
+        if self._updated and self.resultCache is not None:
+            self.resultCache.invalidate()
         self.inTransaction = False
         return True
 
@@ -901,9 +1928,13 @@ class SednaProtocol(object):
 # queries - receivers
 
     def _querySucceeded(self,msg):
-        self.result = Result(self,self.returnUnicode)
-        # sedna immediately sends the first part of the result, so get it.
-        self._get_response()
+        if self._prefetch:
+            self.result = PrefetchResult(self,self.returnUnicode,
+                self._prefetch,self.prefetchBytes)
+        else:
+            self.result = Result(self,self.returnUnicode)
+        # sedna immediately sends the first part of the result.
+        # _get_response keeps reading until we have it.
         return self.result
 
     def _queryFailed(self,msg):
@@ -918,39 +1949,72 @@ class SednaProtocol(object):
         error = ErrorInfo(msg)
         raise SednaError(error)
 
-    def _bulkloadFilelike(self,filelike):
+    def _bulkload(self,source):
         """
-        general internal method for bulk-loading filelikes
+        general internal method for bulk-loading
 
         used in _bulkloadFilename and _bulkloadFromstream
+
+        source is read in large chunks (see readChunks).  Each chunk is cut
+        into maximum-size SEDNA_BULKLOAD_PORTION messages, which are sent
+        together without copying the data.
         """
-        data = filelike.read(LOAD_BUFFER_SIZE)
-        token = SEDNA_BULKLOAD_PORTION
-        while data:
+        sent = 0
+        started = time.time()
+        buffers = []
+        for data in readChunks(source):
             if isinstance(data,unicode):
                 # this should be acceptable. sockets cannot handle
                 # python unicodes, and sedna is always utf-8
                 data = data.encode('utf-8')
-            data = zString(data)
-            self._send_string(data,token,respond=False)
-            data = filelike.read(LOAD_BUFFER_SIZE)
-        filelike.close()
-        self._send_string(token=SEDNA_BULKLOAD_END)
+            if not data:
+                continue
+            if buffers:
+                self._sendBuffers(buffers)
+                # a prefix and a slice of data for each portion
+                self.framesSent += len(buffers) // 2
+                self._bulkloadProgress(sent,started)
+            buffers = portions(data)
+            sent += len(data)
+        # the last portions go in the same write as SEDNA_BULKLOAD_END, so
+        # small documents do not wait on a delayed ACK.
+        buffers.append(HEADER.pack(SEDNA_BULKLOAD_END,0))
+        self._sendBuffers(buffers)
+        self.framesSent += (len(buffers) + 1) // 2
+        self._bulkloadProgress(sent,started)
+        if self.doTrace:
+            logging.getLogger().info("(C) %s" % codes[SEDNA_BULKLOAD_END])
+        return self._get_response()
+
+    def _bulkloadProgress(self,sent,started):
+        if self.doTrace:
+            logging.getLogger().info("(C) %s %s bytes" % (
+                codes[SEDNA_BULKLOAD_PORTION], sent))
+        progress = self._progress
+        if progress is not None:
+            elapsed = time.time() - started
+            if elapsed:
+                progress(sent, sent / elapsed)
+            else:
+                progress(sent, 0.0)
 
     def _bulkloadFilename(self,msg):
         """
         upload the file we asked to upload
         """
         # Int and a byte = 5
-        theFile = open(msg[5:],'r')
-        self._bulkloadFilelike(theFile)
+        theFile = open(msg[DATA_OFFSET:],'rb')
+        try:
+            self._bulkload(theFile)
+        finally:
+            theFile.close()
 
     def _bulkloadFailed(self,msg):
         error = ErrorInfo(msg)
         raise SednaError(error)
 
     def _bulkloadFromstream(self,msg):
-        self._bulkloadFilelike(self._inputBuffer)
+        self._bulkload(utf8Chunks(readChunks(self._inputBuffer)))
 
     def _bulkloadSucceeded(self,msg):
         self._inputBuffer = ''
@@ -958,7 +2022,7 @@ class SednaProtocol(object):
 
     def _lastQueryTime(self,msg):
         #Int-and-a-byte = 5
-        return msg[5:]
+        return msg[DATA_OFFSET:]
 
 # Results processing
 
@@ -966,25 +2030,37 @@ class SednaProtocol(object):
         """
         part of a response is available
         """
-        c = self.currItem
         # 5 is Int + byte
-        c.append(msg[5:])
-        # this is not the final answer, so ask for more...
-        self._get_response()
+        self.currItem.append(msg[DATA_OFFSET:])
 
     def _itemEnd(self,msg):
         item = ''.join(self.currItem)
         self.currItem = []
-        self.result.item = item
+        if self._recording is not None:
+            self._record(item)
+        if self._stats is not None:
+            self._stats.items += 1
+        self.result._receiveItem(item)
 
     def _resultEnd(self,msg):
-        self.result.more = False
         if self.currItem:
             item = ''.join(self.currItem)
             self.currItem = None
-            self.result.item = item
         else:
-            self.result.item = None
+            item = None
+        if self._recording is not None:
+            if item is not None:
+                self._record(item)
+            if self._recording is not None:
+                self.resultCache.put(self._recordKey,self._recording,
+                    self._recordBytes)
+                self._recording = None
+        self.result._receiveEnd(item)
+        if self._stats is not None:
+            if item is not None:
+                self._stats.items += 1
+            if not self._batching:
+                self._finishProfile()
 
 # debug info
 
@@ -1002,7 +2078,6 @@ class SednaProtocol(object):
         except NotImplementedError:
             pass
         self.ermsgs.append(di.info)
-        self._get_response()
 
 # Connection and transaction feedback
 
@@ -1064,3 +2139,11 @@ class SednaProtocol(object):
             SEDNA_SET_SESSION_OPTIONS_OK : _setSessionOptionsOK,
             SEDNA_RESET_SESSION_OPTIONS_OK : _resetSessionOptionsOK
             }
+
+# responses that are followed by more of the same response
+
+    partialResponses = frozenset((
+            SEDNA_QUERY_SUCCEEDED,
+            SEDNA_DEBUG_INFO,
+            SEDNA_ITEM_PART,
+            ))
@@ -0,0 +1,221 @@
+"""
+Query profiling
+
+Set the profiler attribute of a SednaProtocol connection to a callable, and
+it is called with a QueryStats for each query or statement the connection
+executes, once the result has been read to the end:
+
+    def show(stats):
+        print stats.total, stats.bytesReceived, stats.query
+    conn.profiler = show
+
+With profiler None, the default, nothing is collected.  Only the byte and
+frame counters of the connection are kept up to date.
+
+Profile collects the stats of the queries run within a with statement:
+
+    with Profile(conn) as queries:
+        conn.execute(u'...').value
+    print queries[0].firstItem
+
+SlowQueryLog logs the queries that take longer than a threshold, and keeps
+per-query totals for a report:
+
+    slow = SlowQueryLog(threshold=0.5)
+    conn.profiler = slow
+    ...
+    for entry in slow.report(10):
+        print entry.total, entry.count, entry.query
+
+Timings are in seconds.  The server's own processing time (serverTime) costs
+an extra round trip; set profileServerTime on the connection to get it.
+"""
+
+import time
+import logging
+
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
+
+
+class QueryStats(object):
+    """what it took to execute one query
+
+    query           the query, as sent, utf-8 encoded
+    started         when it was sent, as time.time()
+    firstItem       seconds until the first item (or the update's reply)
+                    arrived
+    total           seconds until the last item arrived
+    items           the number of items received
+    bytesSent       bytes sent for the query, including GET_NEXT_ITEM
+    bytesReceived   bytes received for the query
+    framesSent      messages sent
+    framesReceived  messages received
+    serverTime      the server's processing time, a string, if asked for
+    cached          True if the result came from the result cache
+    complete        False if the result was not read to the end
+    error           the error message, if the query failed
+    """
+    __slots__ = ('query','started','firstItem','total','items','bytesSent',
+        'bytesReceived','framesSent','framesReceived','serverTime','cached',
+        'complete','error')
+
+    def __init__(self,query,conn):
+        self.query = query
+        self.firstItem = None
+        self.total = None
+        self.items = 0
+        self.serverTime = None
+        self.cached = False
+        self.complete = True
+        self.error = None
+        # the connection's counters now; finish() takes the difference
+        self.bytesSent = -conn.bytesSent
+        self.bytesReceived = -conn.bytesReceived
+        self.framesSent = -conn.framesSent
+        self.framesReceived = -conn.framesReceived
+        self.started = time.time()
+
+    def finish(self,conn,complete=True,error=None):
+        self.total = time.time() - self.started
+        if self.firstItem is None:
+            self.firstItem = self.total
+        self.bytesSent += conn.bytesSent
+        self.bytesReceived += conn.bytesReceived
+        self.framesSent += conn.framesSent
+        self.framesReceived += conn.framesReceived
+        self.complete = complete
+        self.error = error
+
+    @property
+    def streaming(self):
+        """seconds from the first item to the last"""
+        if self.total is None:
+            return None
+        return self.total - self.firstItem
+
+    def __repr__(self):
+        return '<QueryStats %.6fs %s items %s bytes in: %r>' % (
+            self.total or 0, self.items, self.bytesReceived, self.query[:60])
+
+
+class Profile(object):
+    """collect QueryStats of the queries run on conn in a with statement
+
+    The connection's existing profiler keeps being called.
+    """
+
+    def __init__(self,conn,serverTime=False):
+        self.conn = conn
+        self.serverTime = serverTime
+        self.queries = []
+        self._saved = None
+
+    def __call__(self,stats):
+        self.queries.append(stats)
+        if self._saved[0] is not None:
+            self._saved[0](stats)
+
+    def __enter__(self):
+        conn = self.conn
+        self._saved = (conn.profiler, conn.profileServerTime)
+        conn.profiler = self
+        conn.profileServerTime = self.serverTime or conn.profileServerTime
+        return self.queries
+
+    def __exit__(self,*exc_info):
+        self.conn.profiler, self.conn.profileServerTime = self._saved
+        return False
+
+
+class SlowQueryEntry(object):
+    """totals for one query text in a SlowQueryLog"""
+    __slots__ = ('query','count','slow','total','max','bytesReceived')
+
+    def __init__(self,query):
+        self.query = query
+        self.count = 0
+        self.slow = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytesReceived = 0
+
+    @property
+    def average(self):
+        return self.count and self.total / self.count or 0.0
+
+    def __repr__(self):
+        return '<SlowQueryEntry %s x %.6fs (max %.6fs): %r>' % (self.count,
+            self.average, self.max, self.query[:60])
+
+
+class SlowQueryLog(object):
+    """a profiler that logs slow queries and keeps per-query totals
+
+    threshold    queries taking this many seconds or more are logged, as
+                 warnings
+    logger       a logging.Logger; the root logger if None
+    maxQueries   the most distinct query texts kept in the totals.  Others
+                 are counted under the query text None.
+    queryLength  the most characters of a query logged
+
+    Several connections may share one SlowQueryLog.
+    """
+
+    def __init__(self,threshold=1.0,logger=None,maxQueries=1000,
+            queryLength=200):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger()
+        self.maxQueries = maxQueries
+        self.queryLength = queryLength
+        self.entries = {}
+        self._lock = _threading.Lock()
+
+    def __call__(self,stats):
+        query = stats.query
+        self._lock.acquire()
+        try:
+            entry = self.entries.get(query)
+            if entry is None:
+                if len(self.entries) >= self.maxQueries:
+                    query = None
+                    entry = self.entries.get(None)
+                if entry is None:
+                    entry = self.entries[query] = SlowQueryEntry(query)
+            entry.count += 1
+            entry.total += stats.total
+            entry.bytesReceived += stats.bytesReceived
+            if stats.total > entry.max:
+                entry.max = stats.total
+            slow = stats.total >= self.threshold
+            if slow:
+                entry.slow += 1
+        finally:
+            self._lock.release()
+        if slow:
+            self.logger.warning(
+                'slow query: %.3fs total, %.3fs to first item, %s items, '
+                '%s bytes received: %s', stats.total, stats.firstItem,
+                stats.items, stats.bytesReceived,
+                stats.query[:self.queryLength])
+
+    def report(self,n=None):
+        """return the SlowQueryEntry objects, most total time first"""
+        self._lock.acquire()
+        try:
+            entries = sorted(self.entries.values(),
+                key=lambda entry: entry.total, reverse=True)
+        finally:
+            self._lock.release()
+        if n is not None:
+            entries = entries[:n]
+        return entries
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self._lock.release()
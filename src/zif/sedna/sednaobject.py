@@ -29,12 +29,27 @@ from lxml.etree import _Element, tostring,fromstring, XMLSyntaxError, parse
 from lxml.doctestcompare import norm_whitespace
 from dbapiexceptions import DatabaseError
 from cStringIO import StringIO
+from collections import OrderedDict
+from copy import deepcopy
+from difflib import SequenceMatcher
+from itertools import groupby
+
+import re
 
 import zope.component
 import zope.interface
 
 brace_replacers = {'{':'&#x7b;','}':'&#x7d;'}
 
+# SednaXQuery fetches items for indexing and slicing in windows of this many
+# items, and keeps up to WINDOW_CACHE_SIZE windows
+WINDOW_SIZE = 50
+WINDOW_CACHE_SIZE = 20
+
+# extend and insert_many send at most this many characters of items in one
+# update statement, and use more statements for more
+INSERT_BATCH_SIZE = 262144
+
 def escapeCurlyBraces(s):
     for char in ('{','}'):
         if char in s:
@@ -84,6 +99,129 @@ def checkobj(obj,wf=True):
         return ISednaXMLString(obj)
 
 
+def xqString(value):
+    """return value as an XQuery string literal"""
+    if not isinstance(value,basestring):
+        value = unicode(value)
+    return u'"%s"' % value.replace('&','&amp;').replace('"','&quot;')
+
+def executeUpdates(cursor,statements,nsmap=None):
+    """
+    execute a list of update statements; several are sent pipelined, in one
+    round trip (see SednaProtocol.executeBatch).  A SednaSession keeps them
+    for its next flush.
+    """
+    if isinstance(cursor,SednaSession):
+        cursor.add(statements,nsmap)
+    elif len(statements) == 1:
+        cursor.execute(statements[0], pretty_print=True, nsmap=nsmap)
+    elif statements:
+        cursor.executemany(statements, pretty_print=True, nsmap=nsmap)
+
+def attributeStatement(path,key,value,exists):
+    """
+    the statement that sets an attribute; exists says whether it is there.
+
+    One statement, so that path is only evaluated once: after a delete, a
+    path testing the attribute would no longer find the element.
+    """
+    attribute = u'attribute %s {%s}' % (key,xqString(value))
+    if exists:
+        return u'update replace $a in %s/@%s with %s' % (path,key,attribute)
+    return u'update insert %s into %s' % (attribute,path)
+
+def textStatement(path,text,hasText,hasNodes):
+    """
+    the statement that replaces the text before the first child element, or
+    None if there is nothing to do.  hasText says whether there is such text
+    now, and hasNodes whether the element has any child nodes.
+    """
+    node = u'text {%s}' % xqString(text or u'')
+    if hasText:
+        if text:
+            return u'update replace $t in %s/node()[1] with %s' % (path,node)
+        return u'update delete %s/node()[1]' % path
+    if not text:
+        return None
+    if hasNodes:
+        return u'update insert %s preceding %s/node()[1]' % (node,path)
+    return u'update insert %s into %s' % (node,path)
+
+def transactionOf(cursor):
+    """
+    return the number of the cursor's connection's current transaction, None
+    outside of a transaction
+    """
+    conn = getattr(cursor,'connection',None)
+    if not hasattr(conn,'transactionCount'):
+        # no way to tell; keep what is cached
+        return 0
+    if not conn.inTransaction:
+        return None
+    return conn.transactionCount
+
+def childrenMoved(obj,cursor,path):
+    """
+    tell the IdentityMap that made obj, and its session's, that obj, at
+    path, inserted, deleted or replaced elements
+    """
+    identities = obj._identities
+    if identities is not None:
+        identities.moved(obj,path)
+    if isinstance(cursor,SednaSession) and \
+            cursor.identities is not identities:
+        cursor.identities.moved(obj,path)
+
+_marker = object()
+
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+
+def attribDict(element):
+    """return the attributes of an lxml element as a dict of prefix:name"""
+    attrs = {}
+    prefixes = None
+    for key, value in element.attrib.items():
+        if key.startswith('{'):
+            if prefixes is None:
+                prefixes = dict((uri, prefix) for prefix, uri in
+                    element.nsmap.items() if prefix)
+                prefixes[XML_NAMESPACE] = 'xml'
+            uri, name = key[1:].split('}',1)
+            if uri in prefixes:
+                key = '%s:%s' % (prefixes[uri], name)
+        attrs[key] = value
+    return attrs
+
+def xqItem(obj):
+    """
+    return obj as an XQuery expression to compare items with: XML as it is,
+    with curly braces escaped, and anything else as a string literal
+    """
+    if isinstance(obj,basestring):
+        try:
+            fromstring(obj)
+        except XMLSyntaxError:
+            return xqString(obj)
+        return escapeCurlyBraces(unicode(obj))
+    return checkobj(obj)
+
+def insertChunks(items,size=INSERT_BATCH_SIZE):
+    """
+    yield lists of consecutive items of at most size characters, or of one
+    item if it is bigger than that
+    """
+    chunk = []
+    length = 0
+    for item in items:
+        if chunk and length + len(item) > size:
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(item)
+        length += len(item)
+    if chunk:
+        yield chunk
+
 class SednaXQuery(object):
     """class for read-only xpath queries.  Makes the query result sequence-like.
       slices and stuff...
@@ -91,6 +229,15 @@ class SednaXQuery(object):
       parser         set a parser for output
       pretty_print   set True or False for formatted output
       nsmap          mapping of namespaces used in queries
+      window         the number of items fetched at a time for indexing and
+                     slicing
+      windows        the number of windows kept
+
+      Indexing and slicing fetch the windows of items they need with
+      subsequence(), and keep the most recently used ones.  When items are
+      accessed in order, the next window is fetched along with the one
+      needed.  The count and the windows are kept until the transaction
+      ends, so updates made in the transaction by other means are not seen.
     """
     def __init__(self, cursor, path, **kw):
         self.cursor = cursor
@@ -102,12 +249,36 @@ class SednaXQuery(object):
         self.parser = kw.get('parser', None)
         self.pretty_print = kw.get('pretty_print', False)
         self.nsmap = kw.get('nsmap', {} )
+        self.window = kw.get('window', WINDOW_SIZE)
+        self.maxWindows = kw.get('windows', WINDOW_CACHE_SIZE)
+        self._windows = OrderedDict()
+        self._next = 0
+        self._cachedIn = None
+
+    def _transaction(self):
+        return transactionOf(self.cursor)
+
+    def _current(self):
+        """forget what was cached in an earlier transaction"""
+        transaction = self._transaction()
+        if transaction is None or transaction != self._cachedIn:
+            self._clearCache()
+            self._cachedIn = transaction
+
+    def _clearCache(self):
+        self._count = None
+        self._attrib = None
+        self._windows.clear()
 
+    def _cached(self):
+        """note that the cache is filled in the current transaction"""
+        self._cachedIn = self._transaction()
 
     def count(self):
         """
         return a count of the items returned by the query
         """
+        self._current()
         if self._count is not None:
             return self._count
         #q = u'let $i := %s' % (self.path)
@@ -117,6 +288,7 @@ class SednaXQuery(object):
         s = self.cursor.execute("count(%s)" % self.path, nsmap=self.nsmap)
         #self._count = int(f.c)
         count = self._count = int(s.value)
+        self._cached()
         return count
 
     def xpath(self, path, parser=None, pretty_print=None):
@@ -165,17 +337,114 @@ class SednaXQuery(object):
         """
         retrieve the item at index
         """
+        if isinstance(index,slice):
+            positions = range(*index.indices(self.count()))
+            if not positions:
+                return []
+            low = min(positions)
+            items = self._items(low,max(positions) + 1)
+            return self._parsed([items[k - low] for k in positions])
         if index < 0:
             index += self.count()
-        item = self[index:index+1][0]
-        return item
+            if index < 0:
+                raise IndexError('list index out of range')
+        items = self._items(index,index + 1)
+        if not items:
+            raise IndexError('list index out of range')
+        return self._parsed(items)[0]
+
+    def page(self,number):
+        """return the items of page number (0-based), window items a page"""
+        return self[number * self.window:(number + 1) * self.window]
+
+    def _parsed(self,items):
+        if self.parser:
+            return [self.parser(item) for item in items]
+        return items
+
+    def _items(self,start,stop):
+        """
+        return the unparsed items from start up to stop, from the cached
+        windows or the server
+        """
+        self._current()
+        if stop <= start:
+            return []
+        size = self.window
+        last = (stop - 1) // size
+        sequential = start == self._next
+        self._next = stop
+        k = start // size
+        offset = k * size
+        items = []
+        while k <= last:
+            window = self._cachedWindow(k)
+            if window is None:
+                # fetch the windows up to the next one cached in one query
+                n = 1
+                while n < self.maxWindows and k + n <= last and \
+                        k + n not in self._windows:
+                    n += 1
+                if sequential and k + n > last and n < self.maxWindows:
+                    # read ahead
+                    n += 1
+                windows = self._fetchWindows(k,n)
+            else:
+                windows = [window]
+            for window in windows:
+                if k > last:
+                    break
+                items.extend(window)
+                k += 1
+                if len(window) < size:
+                    # the end of the result
+                    return items[start - offset:stop - offset]
+        return items[start - offset:stop - offset]
+
+    def _itemsPath(self):
+        """the expression for the items indexing and slicing get"""
+        return self.path
+
+    def _cachedWindow(self,k):
+        window = self._windows.pop(k,None)
+        if window is not None:
+            # most recently used goes last
+            self._windows[k] = window
+        return window
+
+    def _fetchWindows(self,first,n):
+        """
+        fetch n windows, starting with window first, in one query
+
+        return the windows, up to the first that is not full.
+        """
+        size = self.window
+        q = u'for $i in subsequence(%s,%s,%s) ' % (self._itemsPath(),
+            first * size + 1,n * size)
+        q += u'return $i'
+        items = list(self.cursor.execute(q, pretty_print=self.pretty_print,
+            nsmap=self.nsmap))
+        windows = []
+        cache = self._windows
+        for k in range(n):
+            window = items[k * size:(k + 1) * size]
+            windows.append(window)
+            cache.pop(first + k,None)
+            while len(cache) >= self.maxWindows:
+                cache.popitem(last=False)
+            cache[first + k] = window
+            if len(window) < size:
+                break
+        self._cached()
+        return windows
 
     def index0(self,obj):
         """
         get the (0-based) index of the item in the list
 
         This uses a brute-force technique, and may not be suitable for large
-        items in long lists
+        items in long lists.  Items are compared by their serialized text, with
+        whitespace normalized; index() compares by value, on the server.
         """
         item = checkobj(obj, wf=False)
         normed = norm_whitespace(item)
@@ -200,27 +469,32 @@ class SednaXQuery(object):
     def index(self,obj):
         """
         get the (0-based) index of the item in the list
+
+        Items are compared by value, as with index-of(), on the server.
         """
-        item = checkobj(obj, wf=False)
-        normed = norm_whitespace(item)
-        #q = u'declare namespace se = "http://www.modis.ispras.ru/sedna";'
-        #q = u''
-        #q = u'declare option se:output "indent=no";'
-        q = u' let $p := %s ,' % self.path
-        q += u' $i := %s ' % item
-        q += u' return <i>{index-of($p,$i)}</i>'
-        try:
-            s = self.cursor.execute(q,pretty_print=self.pretty_print, nsmap=self.nsmap)
-        except DatabaseError:
-            # this is probably an XQuery expression, not an XPath, so
-            # do brute-force evaluation
-            return self.index0(obj)
-        if s:
-            y = fromstring(s.value)
-            if y.text is not None:
-                val = int(y.text)
-                return val-1
-        raise ValueError('item not in list')
+        position = self._position(xqItem(obj))
+        if position is None:
+            raise ValueError('item not in list')
+        return position - 1
+
+    def _position(self,item):
+        """
+        return the (1-based) position of the first item equal to item, an
+        XQuery expression, or None
+        """
+        q = u'(for $i at $p in (%s) where $i = %s return $p)[1]' % (
+            self._itemsPath(),item)
+        s = self.cursor.execute(q, pretty_print=False, nsmap=self.nsmap)
+        value = s.value.strip()
+        if value:
+            return int(value)
+        return None
+
+    def _exists(self,item):
+        """is there an item equal to item, an XQuery expression?"""
+        q = u'exists((%s)[. = %s])' % (self._itemsPath(),item)
+        s = self.cursor.execute(q, pretty_print=False, nsmap=self.nsmap)
+        return s.value.strip() == 'true'
 
     def xenumerate(self):
         for idx,value in enumerate(self):
@@ -230,43 +504,10 @@ class SednaXQuery(object):
         return self.index(obj) + 1
 
     def __contains__(self,obj):
-        item = checkobj(obj, wf=False)
-        wf = True
-        try:
-            t = fromstring(item)
-        except XMLSyntaxError:
-            wf = False
-        if wf:
-            q = u' for $i in %s ' % (self.path,)
-            q += u' where $i = %s ' % item
-            q += u' return $i'
-            s = self.cursor.execute(q,pretty_print=self.pretty_print, nsmap=self.nsmap)
-        else:
-            q = u' for $i in %s ' % (self.path,)
-            q += u' where $i = %(item)s '
-            q += u' return $i'
-            s = self.cursor.execute(q,{'item':item},
-                pretty_print=self.pretty_print, nsmap=self.nsmap)
-        j = s.value
-        if j:
-            return True
-        return False
+        return self._exists(xqItem(obj))
 
     def __getslice__(self,start,stop):
-        #start,stop,step = key.indices(self.count())
-        #if step <> 1:
-        #    raise NotImplementedError('cannot do steps')
-        rlen = stop - start
-        rstart = self._localKey(start)
-        #q =  u'declare namespace se = "http://www.modis.ispras.ru/sedna";'
-        #q = u''
-        #q = u'declare option se:output "indent=no";'
-        q = u'for $i in subsequence(%s,%s,%s) ' % (self.path,rstart,rlen)
-        q += u'return $i'
-        s = list(self.cursor.execute(q, pretty_print=self.pretty_print, nsmap=self.nsmap))
-        if self.parser:
-            return [self.parser(item) for item in s]
-        return s
+        return self._parsed(self._items(max(start,0),stop))
 
     def _iterparse(self,s):
         for item in s:
@@ -295,7 +536,16 @@ class SednaContainer(SednaXQuery):
 
     initialize with a cursor and a path to the element.
 
+    Children are fetched in windows and kept, like the items of a
+    SednaXQuery, until the transaction ends or the container changes them.
+
+    With snapshot=True, the first of the check, len(), tag and attrib gets
+    the count of children, the tag and the attributes in one query.
+
     """
+    # the IdentityMap that made this container, if any
+    _identities = None
+
     def __init__(self, cursor, path, **kw):
         """
         init the class with cursor and path
@@ -303,8 +553,13 @@ class SednaContainer(SednaXQuery):
         know what you are doing...
         """
         super(SednaContainer, self).__init__(cursor, path, **kw)
+        self._tag = _marker
+        self.snapshot = kw.get('snapshot', False)
         if kw.get('check', True):
-            self._checkElement()
+            if self.snapshot:
+                self._loadSnapshot()
+            else:
+                self._checkElement()
 
     def _checkElement(self):
         """
@@ -325,6 +580,51 @@ class SednaContainer(SednaXQuery):
             raise ValueError(
         'Cannot init SednaContainer with multiple elements.')
 
+    def _loadSnapshot(self):
+        """
+        get the count of children, the tag and the attributes in one query,
+        checking that this is a single element
+        """
+        self._current()
+        q = u'let $e := %s return if (count($e) = 1) then ' % self.path
+        q += u'<s n="{count($e/*)}" t="{name($e)}"><a>{$e/@*}</a></s> '
+        q += u'else <c>{count($e)}</c>'
+        s = self.cursor.execute(q, pretty_print=False, nsmap=self.nsmap)
+        info = fromstring(s.value)
+        if info.tag == 'c':
+            if int(info.text) == 0:
+                raise LookupError(
+            'The path did not return an element. ([0] might need to be [1]?)')
+            raise ValueError(
+        'Cannot init SednaContainer with multiple elements.')
+        self._count = int(info.get('n'))
+        self._tag = info.get('t') or None
+        self._attrib = attribDict(info[0])
+        self._cached()
+
+    def _itemsPath(self):
+        return self.path + '/*'
+
+    def _flush(self):
+        """
+        send the updates a session keeps, so that their errors are not taken
+        for the errors of the next query
+        """
+        if isinstance(self.cursor,SednaSession):
+            self.cursor.flush()
+
+    def _changed(self,added=None):
+        """
+        forget the children; the container changed them.  added is how many
+        children that made more (or fewer), if known.
+        """
+        if added is None or self._count is None:
+            self._count = None
+        else:
+            self._count += added
+        self._windows.clear()
+        childrenMoved(self,self.cursor,self.path)
+
     def getparent(self):
         """
         return parent as a SednaContainer or None if at root
@@ -339,8 +639,12 @@ class SednaContainer(SednaXQuery):
     parent = property(getparent)
 
     def count(self, tag=None):
+        self._current()
         if self._count is not None and tag is None:
             return self._count
+        if self.snapshot and tag is None:
+            self._loadSnapshot()
+            return self._count
         if tag:
             pt = tag
         else:
@@ -349,7 +653,10 @@ class SednaContainer(SednaXQuery):
         q += u' return <i><c>{count($i)}</c></i>'
         s = self.cursor.execute(q)
         f = objectify.fromstring(s.value)
+        if tag:
+            return int(f.c)
         self._count = int(f.c)
+        self._cached()
         return self._count
 
     def append(self,obj):
@@ -358,48 +665,60 @@ class SednaContainer(SednaXQuery):
             q = u'update insert %s following %s/*[last()]' % (item,self.path)
         else:
             q = u'update insert %s into %s' % (item,self.path)
-        self.cursor.execute(q, pretty_print=True, nsmap=self.nsmap)
-        self._count = None
+        executeUpdates(self.cursor,[q],self.nsmap)
+        self._changed(1)
 
     def __contains__(self,obj):
         try:
-            s = self.index(obj)
-            return True
+            item = checkobj(obj)
         except ValueError:
             return False
+        self._flush()
+        try:
+            return self._exists(item)
+        except DatabaseError:
+            return False
 
     def index(self,obj):
         """
         get the first (0-based) index of the item in the list
         """
         item = checkobj(obj)
-        normed = norm_whitespace(item)
-        #q = u'declare namespace se = "http://www.modis.ispras.ru/sedna";'
-        #q = u''
-        #q = u'declare option se:output "indent=no";'
-        q = u' let $p := %s/* ,' % self.path
-        q += u' $i := %s ' % item
-        q += u' return <i>{index-of($p,$i)}</i>'
+        self._flush()
         try:
-            s = self.cursor.execute(q, pretty_print=False, nsmap=self.nsmap)
+            position = self._position(item)
         except DatabaseError:
             raise ValueError('item not in list')
-        if s:
-            y = fromstring(s.value)
-            if y.text is not None:
-                val = int(y.text.split()[0])
-                return val-1
-        raise ValueError('item not in list')
+        if position is None:
+            raise ValueError('item not in list')
+        return position - 1
 
     def extend(self,items):
-        for item in items:
-            self.append(item)
-        self._count = None
+        """
+        append items, in as few update statements as INSERT_BATCH_SIZE allows
+        """
+        items = [checkobj(item) for item in items]
+        if items:
+            self._appendItems(items,self.count())
+            self._changed(len(items))
+
+    def _appendItems(self,items,count):
+        """append checked items to the count children there are"""
+        statements = []
+        for chunk in insertChunks(items):
+            if count > 0:
+                q = u'update insert (%s) following %s/*[last()]' % (
+                    u', '.join(chunk),self.path)
+            else:
+                q = u'update insert (%s) into %s' % (u', '.join(chunk),
+                    self.path)
+            statements.append(q)
+            count += len(chunk)
+        executeUpdates(self.cursor,statements,self.nsmap)
 
     def insert(self,key,item):
         local = key+1
         count = self.count()
-        self._count = None
         if local < 1:
             local = count + local
         if local > count:
@@ -410,15 +729,44 @@ class SednaContainer(SednaXQuery):
         item = checkobj(item)
         if count > 0:
             q = u'update insert %s preceding %s/*[%s]' % (item,self.path,local)
-            self.cursor.execute(q, pretty_print=True, nsmap=self.nsmap)
+            executeUpdates(self.cursor,[q],self.nsmap)
+            self._changed(1)
         else:
             self.append(item)
 
+    def insert_many(self,key,items):
+        """
+        insert items, in order, before the child at key, in as few update
+        statements as INSERT_BATCH_SIZE allows
+        """
+        items = [checkobj(item) for item in items]
+        if not items:
+            return
+        local = key+1
+        count = self.count()
+        if local < 1:
+            local = count + local
+        if local > count:
+            self._appendItems(items,count)
+            self._changed(len(items))
+            return
+        elif local < 1:
+            local = 1
+        statements = []
+        for chunk in insertChunks(items):
+            q = u'update insert (%s) preceding %s/*[%s]' % (u', '.join(chunk),
+                self.path,local)
+            statements.append(q)
+            # the child we insert before has moved along
+            local += len(chunk)
+        executeUpdates(self.cursor,statements,self.nsmap)
+        self._changed(len(items))
+
     def remove(self,obj):
         index = self.index(obj) + 1
         q = u'update delete %s/*[%s]' % (self.path,index)
-        self.cursor.execute(q, pretty_print=True, nsmap=self.nsmap)
-        self._count = None
+        executeUpdates(self.cursor,[q],self.nsmap)
+        self._changed(-1)
 
     def __iter__(self):
         q = u' %s/*' % self.path
@@ -430,69 +778,48 @@ class SednaContainer(SednaXQuery):
     def __delitem__(self,key):
         local = self._localKey(key)
         q = u'update delete %s/*[%s]' % (self.path,local)
-        self.cursor.execute(q, pretty_print=True, nsmap=self.nsmap)
-        self._count = None
+        executeUpdates(self.cursor,[q],self.nsmap)
+        self._changed(-1)
+
+    def _clearCache(self):
+        super(SednaContainer, self)._clearCache()
+        self._tag = _marker
 
     @property
     def tag(self):
+        """the element's name, kept for the transaction"""
+        self._current()
+        if self._tag is not _marker:
+            return self._tag
+        if self.snapshot:
+            self._loadSnapshot()
+            return self._tag
         q = u"let $i := %s return <t>{$i/name()}</t>" % self.path
         t1 = self.cursor.execute(q, nsmap=self.nsmap)
         r = fromstring(t1.value)
-        return r.text
+        self._tag = r.text
+        self._cached()
+        return self._tag
         #t = self.path.split('/')[-1]
         #t1 = t.split('[')[0]
         #return t1.strip()
 
-    def __getitem__(self,key):
-        """we get the item at index inside the element"""
-        if isinstance(key,slice):
-            start,stop,step = key.indices(self.count())
-            if step <> 1:
-                raise NotImplementedError('cannot do steps')
-            return self.__getslice__(start,stop)
-        local = self._localKey(key)
-        #q = u'declare namespace se = "http://www.modis.ispras.ru/sedna";'
-        #q = u''
-        #q = u'declare option se:output "indent=no";'
-        q = u' %s/*[%s]' % (self.path,local)
-        s = self.cursor.execute(q, pretty_print=self.pretty_print, nsmap=self.nsmap)
-        z = self.cursor.fetchone()
-        if self.parser:
-            return self.parser(z)
-        return z
-
-
     def __setitem__(self,key,value):
         item = checkobj(value)
         local = self._localKey(key)
         q = u'update replace $i in %s/*[%s] ' % (self.path,local)
         q += ' with %s' % item
-        s = self.cursor.execute(q, pretty_print=True, nsmap=self.nsmap)
+        executeUpdates(self.cursor,[q],self.nsmap)
+        self._changed(0)
 
     def replace(self,obj):
         """ replace item at self.path with the object"""
         item = checkobj(obj)
         q = u'update replace $i in %s ' % (self.path,)
         q += ' with %s' % (item,)
-        self.cursor.execute(q, pretty_print=True, nsmap=self.nsmap)
-        self._attrib = None
-        self._count = None
-
-    def __getslice__(self,start,stop):
-        #start,stop,step = key.indices(self.count())
-        #if step <> 1:
-        #    raise NotImplementedError('cannot do steps')
-        rlen = stop - start
-        rstart = self._localKey(start)
-        #q = u'declare namespace se = "http://www.modis.ispras.ru/sedna";'
-        #q = u''
-        #q = u'declare option se:output "indent=no";'
-        q = u'for $i in subsequence(%s/*,%s,%s) ' % (self.path,rstart,rlen)
-        q += 'return $i'
-        s = list(self.cursor.execute(q,pretty_print=self.pretty_print, nsmap=self.nsmap))
-        if self.parser:
-            return [self.parser(item) for item in s]
-        return s
+        executeUpdates(self.cursor,[q],self.nsmap)
+        self._clearCache()
+        childrenMoved(self,self.cursor,self.path)
 
 #Element attribute access
 
@@ -500,31 +827,59 @@ class SednaContainer(SednaXQuery):
     def attrib(self):
         """get the attributes dict for the element
 
-        do not directly modify this. use obj.set('attr','value')
-        If you need to remove an attribute, str -> edit -> replace is the best
-        option.
+        do not directly modify this. use obj.set('attr','value') and
+        obj.unset('attr').
         """
+        self._current()
         if self._attrib is not None:
             return self._attrib
-        q = u' for $i in %s/@* ' % (self.path)
-        q += u' let $nm := name($i), '
-        q += u' $vl:= data($i)'
-        q += u' return <d><k>{$nm}</k><v>{$vl}</v></d>'
+        if self.snapshot:
+            self._loadSnapshot()
+            return self._attrib
+        # the attributes, copied onto one element
+        q = u'<a>{%s/@*}</a>' % (self.path)
         s = self.cursor.execute(q, pretty_print=False, nsmap=self.nsmap)
-        attrs = {}
-        for k in s:
-            t = objectify.fromstring(k)
-            attrs[str(t.k)] = str(t.v)
-        self._attrib = attrs
+        self._attrib = attribDict(fromstring(s.value))
+        self._cached()
         return self._attrib
 
     def set(self,key,value):
-        q = u'%s' % self.path
-        s = self.cursor.execute(q, nsmap=self.nsmap)
-        fromdb = self.cursor.fetchone()
-        item = objectify.fromstring(fromdb)
-        item.set(key,value)
-        self.replace(item)
+        """
+        set an attribute.  Only the attribute is sent to the server, not the
+        element.  attrib is read first, if it is not cached, to know whether
+        to replace the attribute or insert it.
+        """
+        if not isinstance(value,basestring):
+            value = unicode(value)
+        attrib = self.attrib
+        q = attributeStatement(self.path,key,value,key in attrib)
+        executeUpdates(self.cursor,[q],self.nsmap)
+        attrib[key] = value
+
+    def unset(self,key):
+        """remove an attribute, if there is one"""
+        q = u'update delete %s/@%s' % (self.path,key)
+        executeUpdates(self.cursor,[q],self.nsmap)
+        if self._attrib is not None:
+            self._attrib.pop(key,None)
+
+    def _getText(self):
+        """the text before the first child element, or None"""
+        q = u'%s/node()[1][self::text()]' % self.path
+        s = self.cursor.execute(q, pretty_print=False, nsmap=self.nsmap)
+        return s.value or None
+
+    def _setText(self,text):
+        """replace the text before the first child element"""
+        q = u'let $e := %s return if ($e/node()[1][self::text()]) ' % self.path
+        q += u'then "text" else if ($e/node()) then "nodes" else ""'
+        s = self.cursor.execute(q, pretty_print=False, nsmap=self.nsmap)
+        found = s.value
+        q = textStatement(self.path,text,found == 'text',bool(found))
+        if q is not None:
+            executeUpdates(self.cursor,[q],self.nsmap)
+
+    text = property(_getText,_setText)
 
     def get(self,key):
         """
@@ -559,6 +914,105 @@ zope.component.provideAdapter(containerToSednaXML)
 
 soe_nsmap = {'py': "http://codespeak.net/lxml/objectify/pytype"}
 
+# predicate tests that depend on the content of the element they select
+CONTENT_TESTS = ('.', '*', 'node(', 'text(', 'string(', 'data(')
+
+def stablePath(path,names):
+    """
+    is path sure to keep selecting the same element while the children and
+    attributes called names change?
+
+    A guess from the predicates in path: positions are fine, and tests of
+    anything but names are assumed to be too.
+    """
+    if '[' not in path:
+        return True
+    predicates = path[path.index('['):]
+    for test in CONTENT_TESTS:
+        if test in predicates:
+            return False
+    for name in names:
+        # the local part of {namespace}tag or prefix:name
+        name = name.split('}')[-1].split(':')[-1]
+        if name in predicates:
+            return False
+    return True
+
+def _annotated(element):
+    """a copy of element, annotated for saving as objectifiedToSednaXML does"""
+    element = deepcopy(element)
+    objectify.xsiannotate(element)
+    objectify.deannotate(element,xsi=False)
+    return element
+
+def _savedXML(element):
+    """an annotated element as objectifiedToSednaXML sends it"""
+    s = tostring(element,encoding=unicode,with_tail=False)
+    return escapeCurlyBraces(s.replace(rp,''))
+
+def _snapshot(element):
+    """
+    what save() compares: the tag, attributes and text of an annotated
+    element, and (tag, XML) of each of its child elements
+    """
+    children = [(child.tag, _savedXML(child)) for child in
+        element.iterchildren() if isinstance(child.tag,basestring)]
+    return (element.tag, attribDict(element), element.text, children)
+
+def changeStatements(path,old,new):
+    """
+    return the update statements that turn the element at path from
+    snapshot old into snapshot new, and the names of the attributes and
+    children they change
+    """
+    statements = []
+    names = set()
+    tag, attrib, text, children = new
+    oldTag, oldAttrib, oldText, oldChildren = old
+    for key in oldAttrib:
+        if key not in attrib:
+            statements.append(u'update delete %s/@%s' % (path,key))
+            names.add(key)
+    for key, value in attrib.items():
+        if oldAttrib.get(key) != value:
+            statements.append(attributeStatement(path,key,value,
+                key in oldAttrib))
+            names.add(key)
+    if text != oldText:
+        q = textStatement(path,text,bool(oldText),bool(oldText or oldChildren))
+        if q is not None:
+            statements.append(q)
+    # from the last change to the first, so that the positions of the
+    # children not yet dealt with stay the same
+    matcher = SequenceMatcher(None,oldChildren,children,autojunk=False)
+    for op, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if op == 'equal':
+            continue
+        names.update(tag for tag, xml in oldChildren[i1:i2])
+        names.update(tag for tag, xml in children[j1:j2])
+        items = [xml for tag, xml in children[j1:j2]]
+        if op == 'replace' and i2 - i1 == j2 - j1:
+            for k, item in enumerate(items):
+                statements.append(u'update replace $i in %s/*[%s] with %s' % (
+                    path,i1 + k + 1,item))
+            continue
+        if items:
+            if i2 > 0:
+                target = u'following %s/*[%s]' % (path,i2)
+            elif oldChildren:
+                target = u'preceding %s/*[1]' % path
+            else:
+                target = u'into %s' % path
+            statements.append(u'update insert (%s) %s' % (u', '.join(items),
+                target))
+        if i2 - i1 == 1:
+            statements.append(u'update delete %s/*[%s]' % (path,i2))
+        elif i2 > i1:
+            statements.append(
+                u'update delete %s/*[position() > %s and position() <= %s]' % (
+                path,i1,i2))
+    return statements, names
+
 class SednaObjectifiedElement(object):
     """
        An abstraction of a single Element and its children, objectified with
@@ -571,15 +1025,26 @@ class SednaObjectifiedElement(object):
 
        - init with path and cursor,
        - use the objectify API to modify the element
-       - update() or save() I have not decided...
+       - save()
+
+       The element is read when it is first used, with the check that path
+       refers to a single element in the same query.  save() writes only
+       what changed since then: see save().
 
        The following attributes are used internally, and cannot be used in
        your objects:
         "_cursor"
         "_path"
+        "_nsmap"
         "_element"
+        "_check"
+        "_saved"
+        "_identities"
 
     """
+    # the IdentityMap that made this element, if any
+    _identities = None
+
     def __init__(self, cursor, path, **kw):
         """
         init the class with cursor and path to item
@@ -591,44 +1056,36 @@ class SednaObjectifiedElement(object):
             path = path[:-1]
         self._path = path
         self._nsmap = kw.get('nsmap',{})
-        check = kw.get('check', True)
-        if check:
-            self._checkElement()
-        g = self._fromdb()
-        # parser = objectify.makeparser(ns_clean=True)
-        parser = objectify.makeparser()
-        self._element = objectify.fromstring(g,parser)
-
-    def _checkElement(self):
-        """
-        do a check to see that this is a single element
-        """
-        #q = u'let $i := %s' % (self._path,)
-        q = u'count(%s)' % self._path
-        s = self._cursor.execute(q, nsmap=self._nsmap)
-        c = int(s.value)
-        #f = objectify.fromstring(s.value)
-        #c = int(f.c)
-        if c == 1:
-            return
-        elif c == 0:
-            raise LookupError(
-            'The path did not return an element. ([0] might need to be [1]?)')
+        self.__dict__['_check'] = kw.get('check', True)
+
+    def _load(self):
+        """read the element, and remember it as saved"""
+        path = self._path
+        if self._check:
+            q = u'let $e := %s return if (count($e) = 1) then $e ' % path
+            q += u'else count($e)'
         else:
+            q = u'%s' % path
+        s = self._cursor.execute(q, pretty_print=False, nsmap=self._nsmap)
+        g = s.value
+        if self._check and not g.lstrip().startswith('<'):
+            if int(g) == 0:
+                raise LookupError(
+            'The path did not return an element. ([0] might need to be [1]?)')
             raise ValueError(
         'Cannot init SednaObjectifiedElement with multiple elements.')
+        # parser = objectify.makeparser(ns_clean=True)
+        parser = objectify.makeparser()
+        element = objectify.fromstring(g,parser)
+        self.__dict__['_element'] = element
+        self.__dict__['_saved'] = _snapshot(_annotated(element))
+        return element
 
     def replace(self,s):
         """ replace item at self._path with the object"""
         q = u'update replace $i in %s ' % (self._path,)
         q += ' with %s' % (s,)
-        self._cursor.execute(q, pretty_print=True, nsmap=self._nsmap)
-
-    def _fromdb(self):
-        q = u'%s' % self._path
-        s = self._cursor.execute(q, pretty_print=False, nsmap=self._nsmap)
-        t = s.value
-        return t
+        executeUpdates(self._cursor,[q],self._nsmap)
 
     def getparent(self, parser=None):
         """
@@ -652,7 +1109,35 @@ class SednaObjectifiedElement(object):
         #self._element = e[tag]
 
     def save(self):
-        self.replace(ISednaXMLString(self))
+        """
+        write the changes made since the element was read or last saved
+
+        Each changed, added or removed child element, attribute, and the
+        text, is written with its own update statement, and the statements
+        are sent together.  The whole element is replaced instead when its
+        tag changed, or when the changes might make path select another
+        element part way through (see stablePath).
+        """
+        if '_element' not in self.__dict__:
+            # never read, so nothing changed
+            return
+        annotated = _annotated(self._element)
+        current = _snapshot(annotated)
+        saved = self._saved
+        if current == saved:
+            return
+        path = self._path
+        statements = None
+        if current[0] == saved[0]:
+            statements, names = changeStatements(path,saved,current)
+            if len(statements) > 1 and not stablePath(path,names):
+                statements = None
+        if statements is None:
+            statements = [u'update replace $i in %s with %s' % (path,
+                _savedXML(annotated))]
+        executeUpdates(self._cursor,statements,self._nsmap)
+        self.__dict__['_saved'] = current
+        childrenMoved(self,self._cursor,self._path)
 
     def __delattr__(self,key):
         items = list(self._element[key])
@@ -691,8 +1176,10 @@ class SednaObjectifiedElement(object):
     def __getattr__(self,x):
         """self.x getter.
         this is only called when x is not in the local dict, so we
-        obtain it from the _element
+        obtain it from the _element, which is read on first use
         """
+        if x == '_element':
+            return self._load()
         return getattr(self._element,x)
 
 rp = 'xmlns:py="http://codespeak.net/lxml/objectify/pytype" '
@@ -710,3 +1197,267 @@ def objectifiedToSednaXML(obj):
     return escapeCurlyBraces(s)
 
 zope.component.provideAdapter(objectifiedToSednaXML)
+
+class SednaSession(object):
+    """
+    A unit of work: the updates of the sednaobjects made with a session wait
+    in it, and are sent together.
+
+    Use the session in place of the cursor:
+
+        session = SednaSession(cursor)
+        c = SednaContainer(session,path)
+        c.append(item)
+        c.set('status','done')
+        t = SednaObjectifiedElement(session,otherPath)
+        t.total = 3
+        t.save()
+        session.commit()
+
+    session.container(path) and session.element(path) return the same
+    object for a path for the rest of the transaction (see IdentityMap).
+
+    The updates are kept in the order they were made, so the positions they
+    use are the ones the objects saw, and are sent pipelined, in one round
+    trip (see SednaProtocol.executeBatch), by flush() or commit().  Any query
+    made through the session flushes first, so reads see the updates.  An
+    update that fails raises its error from that query, or from flush() or
+    commit(); the connection has rolled back the transaction by then, and
+    the updates still kept are dropped.
+
+    As a context manager, the session commits at the end of the with
+    statement, or rolls back if there was an exception.
+    """
+
+    def __init__(self,cursor,resolve=False):
+        self.cursor = cursor
+        # (statement, nsmap) in the order they were made
+        self.pending = []
+        self.identities = IdentityMap(self,resolve=resolve)
+
+    def container(self,path,**kw):
+        """the session's SednaContainer for path; see IdentityMap"""
+        return self.identities.container(path,**kw)
+
+    def element(self,path,**kw):
+        """the session's SednaObjectifiedElement for path; see IdentityMap"""
+        return self.identities.element(path,**kw)
+
+    def add(self,statements,nsmap=None):
+        """keep update statements for the next flush"""
+        nsmap = nsmap or {}
+        for statement in statements:
+            self.pending.append((statement,nsmap))
+
+    def flush(self):
+        """
+        send the pending updates.  Consecutive updates with the same nsmap
+        go in one batch.
+        """
+        pending, self.pending = self.pending, []
+        for nsmap, group in groupby(pending, lambda update: update[1]):
+            statements = [statement for statement, nsmap in group]
+            executeUpdates(self.cursor,statements,nsmap)
+
+    def commit(self):
+        """send the pending updates and commit, if a transaction is open"""
+        self.flush()
+        self.identities.clear()
+        conn = self.cursor.connection
+        if conn.inTransaction:
+            return conn.commit()
+
+    def rollback(self):
+        """
+        forget the pending updates and the objects, and roll back, if a
+        transaction is still open: a failed update has rolled it back
+        already
+        """
+        self.pending = []
+        self.identities.clear()
+        conn = self.cursor.connection
+        if conn.inTransaction:
+            return conn.rollback()
+
+    def execute(self,*args,**kw):
+        self.flush()
+        return self.cursor.execute(*args,**kw)
+
+    def executemany(self,*args,**kw):
+        self.flush()
+        return self.cursor.executemany(*args,**kw)
+
+    def __getattr__(self,name):
+        """the rest is the cursor's"""
+        return getattr(self.cursor,name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,excType,excValue,traceback):
+        if excType is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+# string literals in a path, with their doubled-quote escapes
+LITERAL = re.compile(r'''("(?:[^"]|"")*"|'(?:[^']|'')*')''')
+# predicates that select by position
+POSITIONAL = re.compile(r'\[\d+\]|position\(|last\(')
+# white space next to path punctuation
+PATH_SPACE = re.compile(r'\s*([/\[\]()=,])\s*')
+
+def normalizePath(path):
+    r"""
+    path, written one way: without white space around punctuation or
+    trailing slashes, and with string literals in double quotes
+
+    >>> print(normalizePath(u" doc('x') / regions [ @id = 'a' ] / "))
+    doc("x")/regions[@id="a"]
+    >>> print(normalizePath(u"doc('x')/a[@n = 'O''Brien' or @q = 'a\"b']"))
+    doc("x")/a[@n="O'Brien" or @q="a""b"]
+    >>> print(normalizePath(u'doc("x")/a[@n = "say ""hi"" "]'))
+    doc("x")/a[@n="say ""hi"" "]
+    """
+    parts = LITERAL.split(path.strip())
+    for k, part in enumerate(parts):
+        if k % 2:
+            if part.startswith("'"):
+                value = part[1:-1].replace("''","'")
+                parts[k] = '"%s"' % value.replace('"','""')
+        else:
+            parts[k] = PATH_SPACE.sub(r'\1',part)
+    path = ''.join(parts)
+    while path.endswith('/'):
+        path = path[:-1]
+    return path
+
+def isPositional(path):
+    """
+    does path select an element by its position?
+
+    >>> isPositional(u'doc("x")/regions/*[2]/city[last()]')
+    True
+    >>> isPositional(u'doc("x")/regions/africa[@n="[1]"]')
+    False
+    """
+    return POSITIONAL.search(LITERAL.sub('""',normalizePath(path))) is not None
+
+class IdentityMap(object):
+    """
+    The sednaobjects of a transaction, one for each path.
+
+        identities = IdentityMap(cursor)
+        a = identities.container(u"doc('x')/regions")
+        b = identities.container(u'doc("x")/regions/')
+        a is b
+
+    Asking again for a path returns the same object, with what it has
+    cached: tag, count, attributes, or a SednaObjectifiedElement's element
+    and its changes.  Paths are compared as normalizePath writes them, and
+    an object is made with the path it was first asked for with.  Objects
+    are kept only within a transaction; the map forgets them when
+    the connection's transaction ends.  Outside of a transaction, a new
+    object is read at once, which begins one.
+
+    With resolve, the first lookup of a path also asks the server where
+    the element is, so that different paths to one element give one object.
+    The same query checks that the path selects a single element, so the
+    object is made without its own check.
+
+    A path with a position in it, like regions/*[2], may select another
+    element once elements are inserted or deleted.  When a container or
+    element from the map, or from its session, inserts, deletes or replaces
+    elements, the map forgets the other objects for its path or for
+    elements in it, and the objects it found by position (with resolve, all
+    the other objects).  Objects already handed out are not changed: do
+    not keep a positional one across such a change.  Changes made any other
+    way are not seen by the map at all.
+    """
+    def __init__(self,cursor,resolve=False):
+        self.cursor = cursor
+        self.resolve = resolve
+        self._objects = {}
+        self._paths = {}
+        self._transaction = None
+
+    def container(self,path,**kw):
+        """the SednaContainer for path, made with kw the first time"""
+        return self._get(SednaContainer,path,kw)
+
+    def element(self,path,**kw):
+        """the SednaObjectifiedElement for path, made with kw the first time"""
+        return self._get(SednaObjectifiedElement,path,kw)
+
+    def clear(self):
+        self._objects.clear()
+        self._paths.clear()
+
+    def _get(self,factory,path,kw):
+        transaction = transactionOf(self.cursor)
+        if transaction is None or transaction != self._transaction:
+            self.clear()
+        # the object is made with the caller's path; the normalized one is
+        # only a key
+        original = path
+        path = normalizePath(path)
+        key = (factory, self._paths.get(path,path))
+        obj = self._objects.get(key)
+        if obj is not None:
+            return obj
+        if self.resolve:
+            node = self._resolve(original,kw.get('nsmap',{}))
+            self._paths[path] = node
+            key = (factory, node)
+            obj = self._objects.get(key)
+            if obj is not None:
+                return obj
+            kw = dict(kw)
+            kw.setdefault('check',False)
+        obj = factory(self.cursor,original,**kw)
+        if transactionOf(self.cursor) is None:
+            # read it now; that begins the transaction it belongs to
+            obj.tag
+        self._transaction = transactionOf(self.cursor)
+        obj.__dict__['_identities'] = self
+        self._objects[key] = obj
+        return obj
+
+    def moved(self,changer,path):
+        """
+        changer, at path, inserted, deleted or replaced elements: forget the
+        other objects for path or for elements in it, which may have
+        changed, and the objects found by position, which may be other
+        elements now.  With resolve, keys are positions, so everything but
+        changer is forgotten.
+        """
+        path = normalizePath(path)
+        inside = (path + '/', path + '[')
+        for key, obj in list(self._objects.items()):
+            if obj is changer:
+                continue
+            if self.resolve or key[1] == path or \
+                    key[1].startswith(inside) or isPositional(key[1]):
+                del self._objects[key]
+        if self.resolve:
+            self._paths.clear()
+
+    def _resolve(self,path,nsmap):
+        """
+        return where the element at path is, as the document and the position
+        of each ancestor among its siblings with the same name
+        """
+        q = u'let $e := %s return if (count($e) = 1) then ' % path
+        q += u'string-join((document-uri(root($e)), '
+        q += u'for $a in $e/ancestor-or-self::* return concat(name($a), "[", '
+        q += u'count($a/preceding-sibling::*[name() = name($a)]) + 1, "]")), '
+        q += u'"/") else count($e)'
+        s = self.cursor.execute(q, pretty_print=False, nsmap=nsmap)
+        node = s.value
+        if '[' not in node:
+            if int(node) == 0:
+                raise LookupError(
+            'The path did not return an element. ([0] might need to be [1]?)')
+            raise ValueError('The path returned multiple elements.')
+        return node
@@ -10,6 +10,8 @@ def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(doctest.DocFileSuite('README.txt'))
     suite.addTest(doctest.DocFileSuite('README_sednaobject.txt'))
+    suite.addTest(doctest.DocTestSuite('zif.sedna.sednaobject'))
+    suite.addTest(doctest.DocTestSuite('zif.sedna.metrics'))
     #suite.addTest(doctest.DocFileSuite('rtestpath.txt'))
     return suite
 